@@ -0,0 +1,97 @@
+'''
+ASGI entry point serving the routes of server.py, for example with
+
+    uvicorn asgi:app --port 5001
+
+The event loop receives request bodies and sends responses, so idle and slow
+connections do not hold a thread. Only running a view takes one of
+ASGI_THREADS threads (default 8), and the analyses the views start go to the
+worker processes of workers.py when ANALYSIS_WORKERS is set.
+'''
+import io
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from server import app as wsgi_app
+
+executor = ThreadPoolExecutor(int(os.getenv('ASGI_THREADS', '8')))
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('',))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # The whole body is read already, also when it came chunked
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'content-length':
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+def call_wsgi(environ):
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        code = status.split(' ', 1)[0]
+        if not (code.isdigit() and 100 <= int(code) <= 599):
+            # ASGI servers reject other statuses, WSGI servers pass them on
+            print('Invalid status', repr(status), 'for', environ['PATH_INFO'], file=sys.stderr)
+            code = '500'
+        response['status'] = int(code)
+        response['headers'] = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+
+    loop = asyncio.get_running_loop()
+    status, headers, body = await loop.run_in_executor(executor, call_wsgi, wsgi_environ(scope, b''.join(chunks)))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,214 @@
+'''
+Benchmarks of the database.py hot paths on SIM.csv and on copies of it
+scaled up to more patients.
+
+    python bench.py --scales 1,10,100 --out bench.json
+    python bench.py --baseline bench.json --threshold 0.25
+
+Every scale is built from scratch into a temporary cache (init), loaded
+again from that cache (load), and then the queries run on a filter selecting
+all patients and on one selecting a single tumor type, with the filter and
+survival caches emptied before each run. A benchmark's time is the median of
+--repeat runs; one more run under tracemalloc gives its peak allocated bytes.
+With --sketch-size above 0, quantile summaries of that size are built
+(sketch) and filter_to_tukey_approximate runs the same Tukey queries from
+them, whatever the cohort size, for comparison with filter_to_tukey.
+
+With --baseline the results are compared to an earlier results file, and
+the script exits with status 1 if any benchmark got more than --threshold
+slower or used that much more memory. Scale 1000 needs several GB of memory,
+so it only runs when asked for.
+'''
+import os
+import sys
+import json
+import shutil
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import database
+import sketch
+from cache import LRUCache
+
+def scaled_dataset(scale, path, seed=0):
+    '''
+    SIM.csv with every patient repeated scale times. The copies get new
+    patient ids and jittered follow-up times and cell counts, so that they
+    do not tie with the original.
+    '''
+    sim = pd.read_csv('./SIM.csv')
+    rng = np.random.default_rng(seed)
+    data = pd.concat([sim] * scale, ignore_index=True)
+    copy = np.repeat(np.arange(scale), len(sim))
+    data['Pat_ID'] = data['Pat_ID'].astype(str) + '-' + copy.astype(str)
+    jittered = copy > 0
+    data.loc[jittered, 'Time_Diagnosis_Last_followup'] *= rng.uniform(0.95, 1.05, jittered.sum())
+    for column in [c for c in sim.columns if 'TUMOR' in c or 'STROMA' in c]:
+        data.loc[jittered, column] *= rng.lognormal(0, 0.1, jittered.sum())
+    # The column names of the real data, which init expects for other files
+    data['MSI'], data['clinicl_stge'], data['Atomical_location'] = data.MSI_ARTUR, data.clinical_stage, data.Anatomical_location
+    data.to_csv(path, index=False)
+
+def bodies():
+    '''
+    Filter bodies selecting all patients and the patients of the first
+    tumor type, the way the frontend sends them.
+    '''
+    config = database.configuration()
+    body = {v['column']: v['values'] for v in config['variant_values']}
+    for column in database.tumor_specific_filters:
+        body[column] = {}
+    for v in config['tumor_specific_values']:
+        body[v['column']][v['tumor']] = v['values']
+    body.update(
+        tumors=config['tumors'],
+        cells=config['cells'][:3],
+        cell_full=config['cells_full'][0],
+        num_groups=2,
+        group_sizes=None,
+    )
+    return {'all': body, 'tumor': dict(body, tumors=config['tumors'][:1])}
+
+def empty_caches():
+    database.db['cohorts'] = LRUCache(database.db.cohorts.max_size, lambda rows: rows.nbytes)
+    database.db['survival'] = LRUCache(database.db.survival.max_size)
+
+def measure(fn, repeat, memory, setup=empty_caches):
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {'seconds': statistics.median(times), 'min_seconds': min(times)}
+    if memory:
+        setup()
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+def run_scale(scale, repeat, memory, directory, sketch_size=0):
+    if scale == 1:
+        dataset = './SIM.csv'
+    else:
+        dataset = os.path.join(directory, 'SIM-%dx.csv' % scale)
+        scaled_dataset(scale, dataset)
+    os.environ['DATASET'] = dataset
+    cache_dir = os.path.join(directory, 'cache-%dx' % scale)
+    os.environ['DB_CACHE'] = cache_dir
+
+    results = {}
+    # Builds and loads the database, which leaves the scaled one in use
+    results['init'] = measure(database.reload, 1, memory, setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+    results['load'] = measure(database.load_db, repeat, memory, setup=lambda: None)
+    rows = len(database.db.data)
+
+    for name, body in bodies().items():
+        queries = {
+            'filtering': lambda: database.filtering(body),
+            'filter': lambda: database.filter(body),
+            'filter_to_tukey': lambda: database.filter_to_tukey(body),
+            'filter_survival': lambda: database.filter_survival(body),
+            'expression': lambda: database.expression(body),
+            'calculate_size': lambda: database.calculate_size(body),
+        }
+        for query, fn in queries.items():
+            results['%s/%s' % (query, name)] = measure(fn, repeat, memory)
+
+    if sketch_size > 0:
+        max_strata = int(os.getenv('TUKEY_SKETCH_STRATA', '16'))
+        build = lambda: sketch.build(database.db.data, database.db.expression, database.base_filters, database.tumor_specific_filters, sketch_size, max_strata)
+        results['sketch'] = measure(build, 1, memory, setup=lambda: None)
+        database.db['sketches'] = build()
+        database.db['sketch_min_rows'] = 0
+        for name, body in bodies().items():
+            approximate = dict(body, approximate=True)
+            results['filter_to_tukey_approximate/%s' % name] = measure(lambda: database.filter_to_tukey(approximate), repeat, memory)
+
+    for result in results.values():
+        result['rows'] = rows
+    return {'%dx/%s' % (scale, k): v for k, v in results.items()}
+
+def compare(results, baseline, threshold):
+    '''
+    Prints the change of every benchmark in both results and returns the
+    names of those that regressed by more than threshold.
+    '''
+    regressions = []
+    for name, new in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        line = '%-40s %9.4fs %9.4fs %+7.1f%%' % (name, old['seconds'], new['seconds'], 100 * (new['seconds'] / old['seconds'] - 1))
+        regressed = new['seconds'] > old['seconds'] * (1 + threshold)
+        if 'peak_bytes' in old and 'peak_bytes' in new:
+            line += ' %+7.1f%% memory' % (100 * (new['peak_bytes'] / max(old['peak_bytes'], 1) - 1))
+            regressed |= new['peak_bytes'] > old['peak_bytes'] * (1 + threshold)
+        if regressed:
+            line += '  REGRESSION'
+            regressions.append(name)
+        print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--scales', default='1,10,100', help='comma separated patient multipliers (default 1,10,100)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark (default 3)')
+    parser.add_argument('--sketch-size', type=int, default=256, help='quantile summary size for the approximate Tukey benchmarks, 0 to skip them (default 256)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare to the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown as a fraction (default 0.2)')
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+        },
+        'benchmarks': {},
+    }
+    settings = {k: os.environ.get(k) for k in ['DATASET', 'DB_CACHE']}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for scale in [int(s) for s in args.scales.split(',')]:
+                print('Benchmarking %dx' % scale, flush=True)
+                for name, result in run_scale(scale, args.repeat, not args.no_memory, directory, args.sketch_size).items():
+                    print('%-40s %9.4fs' % (name, result['seconds']), flush=True)
+                    results['benchmarks'][name] = result
+    finally:
+        for k, v in settings.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d benchmarks regressed by more than %d%%' % (len(regressions), 100 * args.threshold))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
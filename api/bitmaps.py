@@ -0,0 +1,38 @@
+'''
+Bitmap index over categorical columns.
+
+For every column and value there is one bitmap with a bit set for each row
+holding that value, packed eight rows to a byte. Missing values are indexed
+under 'missing', like fillna('missing') would have them.
+'''
+import numpy as np
+import pandas as pd
+
+def build_index(data, columns):
+    bitmaps = {}
+    for column in columns:
+        values = data[column].astype(object)
+        values = values.where(values.notnull(), 'missing')
+        codes, uniques = pd.factorize(values)
+        bitmaps[column] = {
+            value: np.packbits(codes == i)
+            for i, value in enumerate(uniques)
+        }
+    return dict(size=len(data), bitmaps=bitmaps)
+
+def empty(index):
+    return np.zeros((index['size'] + 7) // 8, dtype=np.uint8)
+
+def any_of(index, column, values):
+    '''
+    Rows where column is one of values, as isin would select them.
+    '''
+    bitmaps = index['bitmaps'][column]
+    res = empty(index)
+    for value in values:
+        if value in bitmaps:
+            res |= bitmaps[value]
+    return res
+
+def rows(index, bitmap):
+    return np.flatnonzero(np.unpackbits(bitmap, count=index['size']))
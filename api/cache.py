@@ -0,0 +1,117 @@
+'''
+In-process caches shared by the request threads.
+'''
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class SingleFlight:
+    '''
+    Runs at most one computation per key at a time. Callers arriving while
+    one is running wait for it and get its result or exception.
+    '''
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, compute):
+        with self.lock:
+            call = self.calls.get(key)
+            running = call is not None
+            if running:
+                self.coalesced += 1
+            else:
+                call = self.calls[key] = Future()
+        if running:
+            return call.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+class LRUCache:
+    '''
+    Least recently used cache bounded by the total size of its values.
+
+    sizeof(value) gives the size of a value, by default each value counts as
+    one so max_size is then the number of entries.
+    '''
+    def __init__(self, max_size, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.flight = SingleFlight()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, _ = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        '''
+        The value for key, computed and stored by compute() when missing.
+        Concurrent misses of one key share a single computation.
+        '''
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        def compute_and_put():
+            # A computation may have finished since the lookup above
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key][0]
+            value = compute()
+            self.put(key, value)
+            return value
+        return self.flight.do(key, compute_and_put)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self.entries),
+                size=self.size,
+                max_size=self.max_size,
+                coalesced=self.flight.coalesced,
+            )
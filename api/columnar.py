@@ -0,0 +1,67 @@
+'''
+Columnar on-disk layout for the dataset frame.
+
+The given float columns are stored as one Fortran ordered matrix, other
+numeric and boolean columns as one array each, and everything else dictionary
+encoded as integer codes plus a list of categories. The arrays are .npy
+files that read_frame maps read-only.
+
+The float matrix, which holds the bulk of the data, stays a view of the map
+so processes loading the same directory share its pages. pandas copies the
+narrow code and integer columns when they are inserted.
+'''
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+def code_dtype(categories):
+    # The code width pandas itself picks, so from_codes does not copy
+    for dtype in (np.int8, np.int16, np.int32):
+        if len(categories) < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def write_frame(directory, df, matrix_columns):
+    os.makedirs(directory, exist_ok=True)
+    # The matrix keeps the order the columns have in the frame
+    matrix_columns = [c for c in df.columns if c in matrix_columns]
+    np.save(os.path.join(directory, 'matrix.npy'), np.asfortranarray(df[matrix_columns].to_numpy(dtype=np.float64)))
+    schema = []
+    for i, c in enumerate(df.columns):
+        values = df[c]
+        if c in matrix_columns:
+            schema.append(dict(name=c, kind='matrix', index=matrix_columns.index(c)))
+        elif values.dtype.kind in 'biuf':
+            np.save(os.path.join(directory, '%d.npy' % i), values.to_numpy())
+            schema.append(dict(name=c, kind='array', file='%d.npy' % i))
+        else:
+            codes, categories = pd.factorize(values)
+            categories = list(categories)
+            if values.isnull().any() and 'missing' not in categories:
+                # Keeps fillna('missing') working on the decoded column
+                categories.append('missing')
+            np.save(os.path.join(directory, '%d.npy' % i), codes.astype(code_dtype(categories)))
+            schema.append(dict(name=c, kind='category', file='%d.npy' % i, categories=categories))
+    with open(os.path.join(directory, 'schema.pickle'), 'wb') as fp:
+        pickle.dump(dict(matrix_columns=matrix_columns, columns=schema), fp)
+
+def read_frame(directory):
+    with open(os.path.join(directory, 'schema.pickle'), 'rb') as fp:
+        schema = pickle.load(fp)
+    load = lambda name: np.load(os.path.join(directory, name), mmap_mode='r')
+    # Built from the matrix first so that its block stays a view of the map
+    df = pd.DataFrame(read_matrix(directory), columns=schema['matrix_columns'], copy=False)
+    for i, column in enumerate(schema['columns']):
+        if column['kind'] == 'array':
+            df.insert(i, column['name'], load(column['file']))
+        elif column['kind'] == 'category':
+            values = pd.Categorical.from_codes(load(column['file']), categories=column['categories'])
+            df.insert(i, column['name'], values)
+    return df
+
+def read_matrix(directory):
+    '''
+    The matrix columns as a read-only map, one row per row of the frame.
+    '''
+    return np.load(os.path.join(directory, 'matrix.npy'), mmap_mode='r')
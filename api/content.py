@@ -0,0 +1,43 @@
+'''
+The editable content documents under /config/content.
+
+Documents are kept in memory as payloads.Payload, reloaded when the file's
+modification time, size or inode changes, which also picks up writes from
+other server processes. Writes replace the file atomically so that readers
+always see a complete version.
+'''
+import os
+import json
+import hashlib
+import threading
+
+import payloads
+import store
+import wire
+
+class Document:
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.payload = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        stat = os.stat(self.path)
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self.lock:
+            if key != self.key:
+                with open(self.path) as fp:
+                    body = wire.dumps(json.load(fp))
+                version = hashlib.sha1(body).hexdigest()[:16]
+                self.payload = payloads.Payload(body, 'application/json', version, stat.st_mtime)
+                self.key = key
+            return self.payload
+
+    def put(self, document):
+        data = json.dumps(document, indent=2).encode()
+        with self.lock:
+            # Needs a writable directory, a file written in place could be
+            # read half written
+            store.atomic_write(self.path, data, mode=0o666)
+            self.key = None
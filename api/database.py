@@ -1,70 +1,29 @@
-from lifelines import CoxPHFitter, KaplanMeierFitter
-from lifelines.exceptions import ConvergenceError
-from lifelines.statistics import multivariate_logrank_test
+from lifelines import CoxPHFitter
 import pandas as pd
 import numpy as np
 import os
+import time
+import threading
 from itertools import accumulate
 
-def uniq(xs):
-    seen = set()
-    return [
-        (seen.add(x), x)[-1]
-        for x in xs
-        if x not in seen
-    ]
-
-def coxph_per_type(dd, cell_types):
-    dd = dd.copy()
-
-    for i in cell_types:
-        if len(uniq(dd[i])) < 2:
-            print("Removing %s column from %i due to single rank", (dd[i], i))
-            del dd[i]
-        else:
-            dd[i] = ntiles(dd[i])
-
-    univariate_results = []
-    for c in cell_types:
-        if c in dd:
-            dd_c = dd[[c, 'T', 'E']]
-            dd_c = dd_c[~pd.isnull(dd_c).any(axis=1)]
-            cph = CoxPHFitter()
-            try:
-              cph.fit(dd_c, 'T', event_col='E') # fits are ~15-60 ms each
-              summary = cph.summary
-              summary.replace([np.inf, -np.inf], np.nan, inplace=True)
-              if not summary.isnull().values.any():
-                  univariate_results.append(summary)
-              else:
-                  print("No summary for %s" % c)
-            except ConvergenceError as err:
-                print(err)
-                continue
-
-    cox = pd.concat(univariate_results)
-    rename = {
-        'exp(coef)': 'coef',
-        'exp(coef) lower 95%': 'lower',
-        'exp(coef) upper 95%': 'upper',
-        'p': 'p',
-    }
-    cox = cox[rename.keys()]
-    cox = cox.rename(columns=rename)
-    return cox
-
-def data_per_type(dd, cell_types):
-    expression = pd.DataFrame({'expression': dd[cell_types].mean()})
-    cox = coxph_per_type(dd, cell_types)
-    return pd.concat((expression, cox), axis=1).dropna()
+from forest import uniq, ntiles, forest_table
+import stats
+import bitmaps
+import sketch
+import workers
+import metrics
 
-ntiles = lambda xs,groups=2: pd.cut(pd.Series(xs).rank(na_option='keep'), groups, right=False, labels=False) + 1
+base_filters = ['clinical_stage', 'pT_stage', 'pN_stage', 'pM_stage', 'Diff_grade', 'Neuralinv', 'Vascinv', 'PreOp_treatment_yesno', 'PostOp_type_treatment']
+tumor_specific_filters = ['Anatomical_location', 'MSI_ARTUR', 'Morphological_type']
 
-def init():
+def init(dataset='./SIM.csv'):
     print("Initialization started", flush=True)
 
-    dataset = os.getenv('DATASET', './SIM.csv')
-    data = pd.read_csv(dataset)
+    if dataset.endswith('.parquet'):
+        # Missing strings come back as None, make them NaN as from a csv
+        data = pd.read_parquet(dataset).fillna(np.nan)
+    else:
+        data = pd.read_csv(dataset)
 
     # Whitespace stripping because of some trailing Morphological_type spaces
     strip = lambda x: x.strip() if isinstance(x, str) else x
@@ -101,19 +60,13 @@ def init():
 
     tumor_types = uniq(data.Tumor_type_code)
     cell_types = uniq(c for c in data.columns if 'TUMOR' in c or 'STROMA' in c)
+    cell_meta = pd.DataFrame({
+        'cell': ['_'.join(c.split('_')[:-1]) for c in cell_types],
+        'location': [c.split('_')[-1] for c in cell_types],
+    }, index=cell_types)
 
-    dfs = []
-    for t in tumor_types:
-        df = data_per_type(data[(data.Tumor_type_code == t)], cell_types)
-        # df = df.astype('float16')
-        df = df.applymap(lambda x: float(f'{x:.3e}'))
-        cell_full = df.index
-        df.reset_index(drop=True, inplace=True)
-        df.insert(0, 'tumor', t)
-        df.insert(1, 'cell', cell_full.map(lambda x: '_'.join(x.split('_')[:-1])))
-        df.insert(2, 'location', cell_full.map(lambda x: x.split('_')[-1]))
-        df.insert(3, 'cell_full', cell_full)
-        dfs.append(df)
+    init_workers = int(os.getenv('INIT_WORKERS', '1'))
+    dfs = forest_table(data, tumor_types, cell_types, init_workers)
 
     # OUTPUT - First result to return
     db = pd.concat(dfs, axis=0).reset_index(drop=True)
@@ -122,6 +75,9 @@ def init():
     # OUTPUT - Second results to return
     codes_list = data[['Tumor_type', 'Tumor_type_code']].to_dict(orient='records')
     codes_dict = {d['Tumor_type_code']: d['Tumor_type'] for d in codes_list}
+
+    # OUTPUT - Bitmaps for the columns filtering() selects on
+    index = bitmaps.build_index(data, ['Tumor_type_code'] + base_filters + tumor_specific_filters)
     print("Initialization finished", flush=True)
 
     return dict(
@@ -130,29 +86,137 @@ def init():
         data=data,
         tumor_types=tumor_types,
         cell_types=cell_types,
+        cell_meta=cell_meta,
+        index=index,
     )
 
-import pickle
+import store
+import columnar
+from cache import LRUCache
+
+# Bump when init() changes what it computes, so that cached databases built
+# by an older version of the code are not loaded.
+SCHEMA_VERSION = 4
 
-def create_db():
+def create_db(dataset):
     print('Creating database', flush=True)
-    db = init()
-    print('Saving pickle', flush=True)
-    pickle.dump(db, open('db.pickle', 'wb'))
+    return init(dataset)
+
+def save_entry(path, db):
+    # The dataset goes in the columnar layout so workers can map it
+    columnar.write_frame(os.path.join(path, 'data'), db['data'], db['cell_types'])
+    store.save_pickle(path, {k: v for k, v in db.items() if k != 'data'})
+
+def load_entry(path):
+    db = store.load_pickle(path)
+    db['data'] = columnar.read_frame(os.path.join(path, 'data'))
+    # Cell columns in cell_types order, NaN where missing
+    db['expression'] = columnar.read_matrix(os.path.join(path, 'data'))
     return db
 
-# create_db()
-
-try:
-    print('Loading pickle', flush=True)
-    db = pickle.load(open('db.pickle', 'rb'))
-except FileNotFoundError:
-    db = create_db()
+def load_db():
+    dataset = os.getenv('DATASET', './SIM.csv')
+    cache_dir = os.getenv('DB_CACHE', './cache')
+    key, db = store.load_or_create(dataset, SCHEMA_VERSION, lambda: create_db(dataset), cache_dir, save_entry, load_entry)
+    db['version'] = key
+    db['modified'] = os.path.getmtime(dataset)
+    # Row selections of recent filters, shared by all endpoints
+    db['cohorts'] = LRUCache(int(os.getenv('FILTER_CACHE_BYTES', 64 << 20)), lambda rows: rows.nbytes)
+    # Results of recent survival requests
+    db['survival'] = LRUCache(int(os.getenv('SURVIVAL_CACHE_SIZE', '256')))
+    # Quantile summaries for approximate Tukey requests, off unless sized
+    sketch_size = int(os.getenv('TUKEY_SKETCH_SIZE', '0'))
+    if sketch_size > 0:
+        max_strata = int(os.getenv('TUKEY_SKETCH_STRATA', '16'))
+        db['sketches'] = sketch.build(db['data'], db['expression'], base_filters, tumor_specific_filters, sketch_size, max_strata)
+    db['sketch_min_rows'] = int(os.getenv('TUKEY_SKETCH_MIN_ROWS', '20000'))
+    return db
 
 class dotdict(dict):
     __getattr__ = dict.get
 
-db=dotdict(db)
+class Database:
+    '''
+    The loaded database, which a reload can replace while requests run.
+
+    Reads go to the version the current thread pinned, or else to the latest
+    one, so a request that pins the latest version at its start keeps seeing
+    it even if a new version is swapped in before it finishes.
+    '''
+    def __init__(self, latest):
+        self.__dict__['latest'] = latest
+        self.__dict__['local'] = threading.local()
+
+    def current(self):
+        pinned = getattr(self.local, 'db', None)
+        return self.latest if pinned is None else pinned
+
+    def pin(self):
+        self.local.db = self.latest
+
+    def unpin(self):
+        self.local.db = None
+
+    def swap(self, latest):
+        self.__dict__['latest'] = latest
+
+    def __getattr__(self, name):
+        return self.current().get(name)
+
+    def __getitem__(self, key):
+        return self.current()[key]
+
+    def __setitem__(self, key, value):
+        self.current()[key] = value
+
+    def __delitem__(self, key):
+        del self.current()[key]
+
+    def __contains__(self, key):
+        return key in self.current()
+
+db = Database(dotdict(load_db()))
+
+def dataset_signature():
+    stat = os.stat(os.getenv('DATASET', './SIM.csv'))
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def reload():
+    '''
+    Loads the database for the current dataset, building it if needed, and
+    swaps it in. Requests keep using the old version until it is ready.
+    '''
+    print('Reloading database', flush=True)
+    latest = dotdict(load_db())
+    # New workers load the new version, running analyses finish on the old
+    workers.reset()
+    db.swap(latest)
+    print('Reloaded database', latest.version, flush=True)
+
+def watch_dataset(interval):
+    '''
+    Polls the dataset every interval seconds in a background thread and
+    reloads once a change has been stable for one interval.
+    '''
+    def poll():
+        loaded = seen = dataset_signature()
+        while True:
+            time.sleep(interval)
+            try:
+                signature = dataset_signature()
+            except OSError as e:
+                print('Cannot read dataset:', str(e), flush=True)
+                continue
+            if signature != loaded and signature == seen:
+                try:
+                    reload()
+                except Exception as e:
+                    print('Reload failed, keeping the loaded database:', repr(e), flush=True)
+                loaded = signature
+            seen = signature
+    thread = threading.Thread(target=poll, name='dataset-watcher', daemon=True)
+    thread.start()
+    return thread
 
 import numpy as np
 
@@ -242,35 +306,77 @@ def filter2(filter_id):
     response = response.drop(columns='cell_full')
     return response
 
-def filtering(filter_id):
-    base_filters = ['clinical_stage', 'pT_stage', 'pN_stage', 'pM_stage', 'Diff_grade', 'Neuralinv', 'Vascinv', 'PreOp_treatment_yesno', 'PostOp_type_treatment']
-    data_filtered = db.data
-    data_filtered = data_filtered.fillna('missing')
-    data_filtered = data_filtered[lambda row: row.Tumor_type_code.isin(filter_id['tumors'])]
+def canonical_filter(filter_id):
+    '''
+    A hashable key for the rows a filter selects: value lists are sorted and
+    deduplicated, tumor specific values are only kept for selected tumors and
+    keys that do not affect the rows (cells, cell_full, ...) are left out.
+    '''
+    values = lambda xs: tuple(sorted(set(xs), key=repr))
+    tumors = values(filter_id['tumors'])
+    key = [('tumors', tumors)]
+    for k in base_filters:
+        key.append((k, values(filter_id[k])))
+    for specific in tumor_specific_filters:
+        key.append((specific, tuple(sorted(
+            (tumor, values(vs))
+            for tumor, vs in filter_id[specific].items()
+            if tumor in tumors
+        ))))
+    return tuple(key)
+
+def select(index, filter_id):
+    '''
+    Bitmap of the rows of a bitmap index over the filter columns that the
+    filter selects.
+    '''
+    selected = bitmaps.any_of(index, 'Tumor_type_code', filter_id['tumors'])
 
     for key in base_filters:
-        data_filtered = data_filtered[data_filtered[key].isin(filter_id[key])]
+        selected &= bitmaps.any_of(index, key, filter_id[key])
 
-    for specific in ['Anatomical_location', 'MSI_ARTUR', 'Morphological_type']:
+    for specific in tumor_specific_filters:
         for tumor, values in filter_id[specific].items():
-            data_filtered = data_filtered[lambda row: (row.Tumor_type_code != tumor) | row[specific].isin(values)]
+            # Rows of other tumor types pass, rows of this one need a listed value
+            selected &= ~bitmaps.any_of(index, 'Tumor_type_code', [tumor]) | bitmaps.any_of(index, specific, values)
+    return selected
+
+def filtered_rows(filter_id):
+    cache_key = canonical_filter(filter_id)
+    rows = db.cohorts.get(cache_key)
+    if rows is not None:
+        return rows
+
+    index = db.index
+    with metrics.phase('filtering'):
+        rows = bitmaps.rows(index, select(index, filter_id)).astype(np.int32)
+    rows.setflags(write=False)
+    db.cohorts.put(cache_key, rows)
+    return rows
 
-    return data_filtered
+def filtering(filter_id):
+    rows = filtered_rows(filter_id)
+    with metrics.phase('reshape'):
+        return db.data.iloc[rows].fillna('missing')
 
 def filter(filter_id):
+    rows = filtered_rows(filter_id)
+    meta = db.cell_meta
 
-    response = filtering(filter_id)
-    response = response.melt(id_vars='Tumor_type_code')
-    response.columns = ['tumor', 'cell_full', 'expression']
+    with metrics.phase('reshape'):
+        # Only the requested cell columns, in long form column by column
+        columns = np.flatnonzero(meta.cell.isin(filter_id['cells']))
+        values = db.expression[rows][:, columns].T.ravel()
+        expression = values.astype(object)
+        expression[np.isnan(values)] = 'missing'
 
-    # Split the cell_full to cell and location
-    response.insert(2, 'cell', response['cell_full'].map(lambda x: '_'.join(x.split('_')[:-1])))
-    response.insert(3, 'location', response['cell_full'].map(lambda x: x.split('_')[-1]))
-
-    # Filter based on the requested cells
-    response = response[response['cell'].isin(filter_id['cells'])]
-    response = response.drop(columns='cell_full')
-    return response
+        tumors = db.data.Tumor_type_code.iloc[rows].to_numpy(dtype=object)
+        return pd.DataFrame({
+            'tumor': np.tile(tumors, len(columns)),
+            'cell': np.repeat(meta.cell.to_numpy()[columns], len(rows)),
+            'location': np.repeat(meta.location.to_numpy()[columns], len(rows)),
+            'expression': expression,
+        })
 
 
 def binning(data_filtered, cell, group_sizes):
@@ -284,65 +390,73 @@ def binning(data_filtered, cell, group_sizes):
     return pd.cut(data_filtered[cell], bins=group_values, include_lowest=True, right=False, labels=False) + 1
 
 
+def survival_key(filter_id):
+    '''
+    A hashable key for the result of filter_survival.
+    '''
+    if filter_id['group_sizes'] != None:
+        groups = ('group_sizes', tuple(filter_id['group_sizes']))
+    else:
+        groups = ('num_groups', filter_id['num_groups'])
+    return (canonical_filter(filter_id), filter_id['cell_full'], groups, bool(filter_id.get('stratified', False)))
+
 def filter_survival(filter_id):
+    '''
+    Survival analysis of the filter, from the cache of recent results when
+    possible. Identical requests arriving together share one computation,
+    which runs in the analysis workers.
+    '''
+    return db.survival.get_or_compute(survival_key(filter_id), lambda: workers.run(survival_analysis, filter_id))
+
+def survival_analysis(filter_id):
 
     data_filtered = filtering(filter_id)
     data_filtered = data_filtered[data_filtered[filter_id['cell_full']] != "missing"]
 
-    # Get the groups for ntiles and run the Kaplan Meier fitter for each of them
+    # Get the groups for ntiles
     # If the group_sizes are provided, use the binning function, otherwise the general ntiles
     if filter_id['group_sizes'] != None:
         data_filtered['rank'] = binning(data_filtered.sort_values(by=filter_id['cell_full']), filter_id['cell_full'], filter_id['group_sizes'])
     else:
         data_filtered['rank'] = ntiles(data_filtered[filter_id['cell_full']], filter_id['num_groups'])
-    points = []
     # OBS: checking the number of groups after filtering
     num_groups = len(uniq(data_filtered['rank']))
     if num_groups < 2:
         raise ValueError('Number of groups must be at least two.')
-    points_dfs = []
-    alive_dfs = []
-    for g in range(num_groups):
-        kmf = KaplanMeierFitter()
-        data = data_filtered[lambda row: row['rank'] == g+1]
-        kmf.fit(
-            data['T'],
-            data['E'],
-            label='Kaplan_Meier',
-        )
-        df = pd.concat([
-            kmf.survival_function_,
-            kmf.confidence_interval_survival_function_,
-        ], axis=1)
-        df['group'] = g+1
-        points_dfs += [df]
-
-        alive_df = kmf.survival_function_at_times(data[data['E']==False]['T']).to_frame().reset_index()
-        alive_df['group'] = g+1
-        alive_dfs += [alive_df]
-
-    # Curate points and alive points
-    points_df = pd.concat(points_dfs).reset_index().rename(columns={
-        'index': 'time',
-        'Kaplan_Meier': 'fit',
-        'Kaplan_Meier_lower_0.95': 'lower',
-        'Kaplan_Meier_upper_0.95': 'upper',
-    })
-    points = points_df.to_dict(orient='records')
-
-    alive_points_df = pd.concat(alive_dfs).rename(columns={
-        'index': 'time',
-        'Kaplan_Meier': 'fit',
-        'group': 'group',
-    })
-    alive_points = alive_points_df.to_dict(orient='records')
+
+    with metrics.phase('statistics'):
+        return survival_statistics(data_filtered, num_groups, filter_id.get('stratified', False))
+
+def survival_statistics(data_filtered, num_groups, stratified):
+    # All Kaplan Meier curves at once, for the ranks 1..num_groups
+    in_groups = data_filtered['rank'].between(1, num_groups).to_numpy()
+    grouped = data_filtered[in_groups]
+    table = stats.event_table(grouped['T'], grouped['E'], grouped['rank'].to_numpy(dtype=int) - 1, num_groups)
+    curves, at = stats.kaplan_meier(table)
+    curves['group'] += 1
+    points = curves[['time', 'fit', 'lower', 'upper', 'group']].to_dict(orient='records')
+
+    # The curve at the censoring times, group by group in row order
+    alive = ~grouped['E'].to_numpy(dtype=bool)
+    alive_order = np.argsort(grouped['rank'].to_numpy()[alive], kind='stable')
+    alive_points = pd.DataFrame({
+        'time': grouped['T'].to_numpy()[alive][alive_order],
+        'fit': curves.fit.to_numpy()[at[alive][alive_order]],
+        'group': curves.group.to_numpy()[at[alive][alive_order]],
+    }).to_dict(orient='records')
 
     # Run multivarate analysis
-    log_rank = multivariate_logrank_test(data_filtered['T'], data_filtered['rank'], data_filtered['E'])
+    statistic, p, _ = stats.logrank(table)
     log = {
-        'test_statistic_logrank': log_rank.summary['test_statistic'][0],
-        'p_logrank': log_rank.summary['p'][0]
+        'test_statistic_logrank': statistic,
+        'p_logrank': p
     }
+    if stratified:
+        # The same test within tumor types, asked for with stratified: true
+        strata = pd.factorize(grouped['Tumor_type_code'])[0]
+        statistic, p, _ = stats.logrank(stats.event_table(grouped['T'], grouped['E'], grouped['rank'].to_numpy(dtype=int) - 1, num_groups, strata))
+        log['test_statistic_logrank_stratified'] = statistic
+        log['p_logrank_stratified'] = p
 
     # Run cox regression
     cph = CoxPHFitter()
@@ -361,6 +475,98 @@ def filter_survival(filter_id):
         cox['lower'] = 0.0
     return {'points': points, 'log_rank': log, 'cox_regression': cox, 'live_points': alive_points}
 
+def cutpoints(filter_id):
+    '''
+    Log-rank statistic and hazard ratio of every two group split of the
+    cohort by cell_full, the groups as binning() makes them from group sizes
+    size_low and size_high, and the best split's p-value corrected for
+    having picked the maximum. Both groups hold at least min_fraction of the
+    cohort, by default 0.1. Large cohorts return max_points (default 500)
+    evenly spaced cutpoints and the best one.
+    '''
+    data_filtered = filtering(filter_id)
+    data_filtered = data_filtered[data_filtered[filter_id['cell_full']] != "missing"]
+    min_fraction = filter_id.get('min_fraction', 0.1)
+
+    with metrics.phase('statistics'):
+        res = stats.cutpoints(
+            data_filtered[filter_id['cell_full']].astype(float),
+            data_filtered['T'],
+            data_filtered['E'],
+            min_fraction,
+        )
+    res = res.replace([np.inf, -np.inf], np.nan)
+    # Without deaths in the cohort every statistic is missing
+    if res.statistic.isnull().all():
+        raise ValueError('No cutpoint leaves min_fraction of the cohort in both groups.')
+    best = res.statistic.idxmax()
+    max_points = filter_id.get('max_points', 500)
+    kept = np.union1d(np.round(np.linspace(0, len(res) - 1, min(max_points, len(res)))).astype(int), [best])
+    records = res.iloc[kept].astype(object).where(res.iloc[kept].notnull(), None).to_dict(orient='records')
+    return {
+        'cutpoints': records,
+        'best': records[int(np.searchsorted(kept, best))],
+        'p_corrected': stats.maxstat_p(res.statistic[best], min_fraction),
+    }
+
+def configuration():
+    '''
+    The filter columns and their values, the tumor types and the cell types.
+    '''
+    def tidy_values(values):
+        values = sorted(values, key=lambda x: (isinstance(x, float), x))
+        values = [ 'missing' if pd.isnull(v) else v for v in values ]
+        values = uniq(values)
+        return values
+    tumor_specific_columns = [
+        'Anatomical_location',
+        'Morphological_type',
+        'MSI_ARTUR',
+    ]
+    tumor_specific_values = []
+    for column in tumor_specific_columns:
+        # values = uniq(data[c][lambda x: ~pd.isnull(x)])
+        # print(c, values, flush=True)
+        for tumor in db.tumor_types:
+            values = tidy_values(db.data[db.data.Tumor_type_code == tumor][column])
+            if len(values) > 1:
+                tumor_specific_values.append({
+                    'column': column,
+                    'tumor': tumor,
+                    'values': values
+                })
+    variant_columns = [
+        # 'Tumor_type_code',
+        # 'Gender',
+        # 'Anatomical_location',
+        # 'Morphological_type',
+        'clinical_stage',
+        'pT_stage',
+        'pN_stage',
+        'pM_stage',
+        'Diff_grade',
+        'Neuralinv',
+        'Vascinv',
+        'PreOp_treatment_yesno',
+        'PostOp_type_treatment',
+        # 'MSI_ARTUR',
+    ]
+    variant_values = []
+    for column in variant_columns:
+        values = tidy_values(db.data[column])
+        variant_values.append({
+            'column': column,
+            'values': values
+        })
+    return {
+        'variant_values': variant_values,
+        'tumor_specific_values': tumor_specific_values,
+        'tumors': db.tumor_types,
+        'cells_full': db.cell_types,
+        'cells': tidy_values('_'.join(c.split('_')[:-1]) for c in db.cell_types),
+        'tumor_codes': db.codes_dict,
+    }
+
 def calculate_size(filter_id):
     data_filtered = filtering(filter_id)
     return {'size': data_filtered.shape[0]}
@@ -373,8 +579,40 @@ def expression(filter_id):
 
 
 def filter_to_tukey(body):
-    df_long = filter(body)
-    g = df_long.groupby(['tumor', 'cell', 'location'])
-    return Tukey_grouped_series(g.expression).reset_index()
-
-
+    '''
+    Boxplot statistics per tumor and requested cell column.
+
+    With approximate set in the body and quantile summaries loaded (see
+    sketch.py) large cohorts are answered from the summaries, and the result
+    gets a rank_error column bounding the error of the quantiles, whiskers and
+    outlier counts as a fraction of the group size. Smaller cohorts and
+    filters the summaries cannot answer are computed exactly, with rank_error
+    0.
+    '''
+    meta = db.cell_meta
+    columns = np.flatnonzero(meta.cell.isin(body['cells']))
+    approximate = body.get('approximate', False) and db.sketches is not None
+    if approximate:
+        sketches = db.sketches
+        strata = sketch.select(sketches, body)
+        approximate = strata is not None and sketches['rows'][strata].sum() >= db.sketch_min_rows
+
+    if approximate:
+        with metrics.phase('statistics'):
+            res, tumors = sketch.tukey(sketches, strata, columns)
+    else:
+        rows = filtered_rows(body)
+        with metrics.phase('reshape'):
+            tumor_codes, tumors = pd.factorize(db.data.Tumor_type_code.iloc[rows].to_numpy(dtype=object))
+            # One group per tumor and requested cell column
+            values = db.expression[rows][:, columns]
+            groups = tumor_codes[:, None] * len(columns) + np.arange(len(columns))
+        with metrics.phase('statistics'):
+            res = stats.tukey(values.ravel(), groups.ravel(), len(tumors) * len(columns))
+        if body.get('approximate', False):
+            res['rank_error'] = 0.0
+
+    res.insert(0, 'tumor', np.repeat(tumors, len(columns)))
+    res.insert(1, 'cell', np.tile(meta.cell.to_numpy()[columns], len(tumors)))
+    res.insert(2, 'location', np.tile(meta.location.to_numpy()[columns], len(tumors)))
+    return res.sort_values(['tumor', 'cell', 'location']).reset_index(drop=True)
@@ -0,0 +1,103 @@
+'''
+The forest plot table: mean expression and univariate Cox regression per
+cell column, computed independently for every tumor type.
+
+Kept apart from database.py so that pool workers can import it without
+loading the database.
+'''
+from lifelines import CoxPHFitter
+from lifelines.exceptions import ConvergenceError
+import pandas as pd
+import numpy as np
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+import stats
+import workers as pool_workers
+
+def uniq(xs):
+    seen = set()
+    return [
+        (seen.add(x), x)[-1]
+        for x in xs
+        if x not in seen
+    ]
+
+def coxph_per_type(dd, cell_types):
+    dd = dd.copy()
+
+    for i in cell_types:
+        if len(uniq(dd[i])) < 2:
+            print("Removing %s column from %i due to single rank", (dd[i], i))
+            del dd[i]
+        else:
+            dd[i] = ntiles(dd[i])
+
+    columns = [c for c in cell_types if c in dd]
+    batched = stats.coxph_univariate(dd['T'], dd['E'], dd[columns], names=columns)
+
+    univariate_results = [batched.loc[batched.converged, ['coef', 'lower', 'upper', 'p']]]
+    for c in batched.index[~batched.converged]:
+        # Fall back to lifelines for the few columns Newton-Raphson could not handle
+        summary = coxph_lifelines(dd, c)
+        if summary is not None:
+            univariate_results.append(summary)
+
+    return pd.concat(univariate_results)
+
+def coxph_lifelines(dd, c):
+    dd_c = dd[[c, 'T', 'E']]
+    dd_c = dd_c[~pd.isnull(dd_c).any(axis=1)]
+    cph = CoxPHFitter()
+    try:
+        cph.fit(dd_c, 'T', event_col='E') # fits are ~15-60 ms each
+    except ConvergenceError as err:
+        print(err)
+        return None
+    summary = cph.summary
+    summary.replace([np.inf, -np.inf], np.nan, inplace=True)
+    if summary.isnull().values.any():
+        print("No summary for %s" % c)
+        return None
+    rename = {
+        'exp(coef)': 'coef',
+        'exp(coef) lower 95%': 'lower',
+        'exp(coef) upper 95%': 'upper',
+        'p': 'p',
+    }
+    summary = summary[rename.keys()]
+    return summary.rename(columns=rename)
+
+def data_per_type(dd, cell_types):
+    expression = pd.DataFrame({'expression': dd[cell_types].mean()})
+    cox = coxph_per_type(dd, cell_types)
+    return pd.concat((expression, cox), axis=1).dropna()
+
+def forest_per_type(t, dd, cell_types):
+    df = data_per_type(dd, cell_types)
+    # df = df.astype('float16')
+    df = df.applymap(lambda x: float(f'{x:.3e}'))
+    cell_full = df.index
+    df.reset_index(drop=True, inplace=True)
+    df.insert(0, 'tumor', t)
+    df.insert(1, 'cell', cell_full.map(lambda x: '_'.join(x.split('_')[:-1])))
+    df.insert(2, 'location', cell_full.map(lambda x: x.split('_')[-1]))
+    df.insert(3, 'cell_full', cell_full)
+    return df
+
+def forest_table(data, tumor_types, cell_types, workers=1):
+    '''
+    Per tumor type tables of mean expression and univariate Cox results.
+
+    With more than one worker the tumor types are fitted in a process pool,
+    started like the analysis workers as init can run in a server thread.
+    Results still come back in tumor_types order.
+    '''
+    frames = [data[(data.Tumor_type_code == t)] for t in tumor_types]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_workers.context()) as executor:
+            return list(executor.map(forest_per_type, tumor_types, frames, repeat(cell_types)))
+    else:
+        return list(map(forest_per_type, tumor_types, frames, repeat(cell_types)))
+
+ntiles = lambda xs,groups=2: pd.cut(pd.Series(xs).rank(na_option='keep'), groups, right=False, labels=False) + 1
@@ -0,0 +1,249 @@
+'''
+Load test of the api with the calls the frontend makes.
+
+    python loadtest.py --requests 500 --concurrency 8
+    python loadtest.py --url http://localhost:5001 --replay requests.jsonl --duration 60
+
+Without --url the app in server.py is called in this process through its
+test client, which measures the views without a web server, with --url a
+running server (uwsgi, the development server or the ASGI entry point) is
+called over http.
+
+The requests are replayed from a file with one JSON object with method,
+path and body per line, as the server writes them when started with
+REQUEST_LOG (see the README), or else synthesized: filters with random
+tumor types, values and cells sent to /api/configuration, /api/tukey,
+/api/filter, /api/size, /api/survival and /api/expression in the
+proportions of --mix. --save writes the requests sent, for replaying the
+same mix later.
+
+Throughput, latency percentiles, error rates and response sizes are printed
+per endpoint, and written as JSON with --out.
+'''
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_MIX = 'configuration=1,tukey=3,filter=1,size=4,survival=2,expression=1'
+
+TUMOR_SPECIFIC_COLUMNS = ['Anatomical_location', 'Morphological_type', 'MSI_ARTUR']
+
+class InProcess:
+    def __init__(self):
+        import server
+        self.app = server.app
+        # Test clients keep cookies, one per thread
+        self.local = threading.local()
+
+    def send(self, method, path, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers={'Accept-Encoding': 'gzip'})
+        return response.status_code, len(response.get_data())
+
+    def get_json(self, path):
+        return self.app.test_client().get(path).get_json()
+
+class Remote:
+    def __init__(self, url, timeout=300):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def send(self, method, path, body):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+
+    def get_json(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as response:
+            return json.load(response)
+
+def subset(rng, values, at_least=1):
+    picked = rng.choice(len(values), rng.integers(at_least, len(values) + 1), replace=False)
+    return [values[i] for i in sorted(picked)]
+
+def random_filter(config, rng):
+    '''
+    A filter body as the frontend sends it: some tumor types, all values of
+    most filter columns and some of the rest, and up to three cell types.
+    '''
+    tumors = subset(rng, config['tumors'])
+    body = {
+        v['column']: v['values'] if rng.random() < 0.7 else subset(rng, v['values'])
+        for v in config['variant_values']
+    }
+    for column in TUMOR_SPECIFIC_COLUMNS:
+        body[column] = {}
+    for v in config['tumor_specific_values']:
+        if v['tumor'] in tumors:
+            body[v['column']][v['tumor']] = v['values']
+    body.update(
+        tumors=tumors,
+        cells=subset(rng, config['cells'])[:3],
+        cell_full=config['cells_full'][rng.integers(len(config['cells_full']))],
+        num_groups=int(rng.integers(2, 5)),
+        group_sizes=None,
+    )
+    return body
+
+def synthesize(config, mix, rng):
+    '''
+    Requests without end, the endpoints drawn in the proportions of mix.
+    '''
+    endpoints = list(mix)
+    p = np.array([mix[e] for e in endpoints], dtype=float)
+    p /= p.sum()
+    while True:
+        endpoint = endpoints[rng.choice(len(endpoints), p=p)]
+        if endpoint == 'configuration':
+            yield {'method': 'GET', 'path': '/api/configuration', 'body': None}
+        elif endpoint in ['tukey', 'filter']:
+            # The frontend compares up to three filters side by side
+            bodies = [random_filter(config, rng) for _ in range(rng.integers(1, 4))]
+            yield {'method': 'POST', 'path': '/api/' + endpoint, 'body': bodies}
+        else:
+            yield {'method': 'POST', 'path': '/api/' + endpoint, 'body': random_filter(config, rng)}
+
+def replay(path):
+    with open(path) as fp:
+        recorded = [json.loads(line) for line in fp if line.strip()]
+    if not recorded:
+        raise ValueError('No requests in ' + path)
+    while True:
+        yield from recorded
+
+def run(target, requests, concurrency, count=None, duration=None, save=None):
+    '''
+    Sends requests from concurrency threads until count are sent or
+    duration seconds passed. Returns (path, seconds, status, bytes) per
+    request and the wall time.
+    '''
+    lock = threading.Lock()
+    results = []
+    sent = [0]
+    deadline = None if duration is None else time.perf_counter() + duration
+
+    def next_request():
+        with lock:
+            if count is not None and sent[0] >= count:
+                return None
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            sent[0] += 1
+            item = next(requests)
+            if save is not None:
+                save.write(json.dumps(item) + '\n')
+            return item
+
+    def worker():
+        while True:
+            item = next_request()
+            if item is None:
+                return
+            start = time.perf_counter()
+            try:
+                status, size = target.send(item['method'], item['path'], item['body'])
+            except Exception as e:
+                print('Request to', item['path'], 'failed:', str(e))
+                status, size = None, 0
+            with lock:
+                results.append((item['path'], time.perf_counter() - start, status, size))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - start
+
+def summarize(results, wall):
+    '''
+    Per endpoint and in total: requests, throughput, error rate, latency
+    percentiles in milliseconds and mean response size.
+    '''
+    summary = {}
+    paths = sorted(set(r[0] for r in results))
+    for path in paths + ['total']:
+        rows = [r for r in results if path in ['total', r[0]]]
+        seconds = np.array([r[1] for r in rows])
+        errors = sum(1 for r in rows if r[2] is None or r[2] >= 400)
+        p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+        summary[path] = {
+            'requests': len(rows),
+            'per_second': len(rows) / wall,
+            'errors': errors,
+            'error_rate': errors / len(rows),
+            'p50_ms': p50,
+            'p90_ms': p90,
+            'p99_ms': p99,
+            'max_ms': seconds.max() * 1000,
+            'mean_bytes': float(np.mean([r[3] for r in rows])),
+        }
+    return summary
+
+def print_summary(summary):
+    print('%-20s %8s %8s %7s %9s %9s %9s %11s' % ('endpoint', 'requests', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'mean bytes'))
+    for path, s in summary.items():
+        print('%-20s %8d %8.1f %6.1f%% %9.1f %9.1f %9.1f %11.0f' % (
+            path, s['requests'], s['per_second'], 100 * s['error_rate'],
+            s['p50_ms'], s['p90_ms'], s['p99_ms'], s['mean_bytes']))
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        endpoint, weight = part.split('=')
+        mix[endpoint.strip()] = float(weight)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--url', help='server to call, e.g. http://localhost:5001 (default: the app in this process)')
+    parser.add_argument('--replay', help='file of recorded requests, one JSON object per line')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the synthesized endpoints (default %s)' % DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthesized requests (default 0)')
+    parser.add_argument('--concurrency', type=int, default=4, help='requests in flight (default 4)')
+    parser.add_argument('--requests', type=int, help='number of requests to send (default 200 without --duration)')
+    parser.add_argument('--duration', type=float, help='seconds to send requests for')
+    parser.add_argument('--save', help='write the requests sent to this file, for --replay')
+    parser.add_argument('--out', help='write the summary to this JSON file')
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 200
+
+    target = Remote(args.url) if args.url else InProcess()
+    if args.replay:
+        requests = replay(args.replay)
+    else:
+        config = target.get_json('/api/configuration')
+        requests = synthesize(config, parse_mix(args.mix), np.random.default_rng(args.seed))
+
+    save = open(args.save, 'w') if args.save else None
+    try:
+        results, wall = run(target, requests, args.concurrency, args.requests, args.duration, save)
+    finally:
+        if save is not None:
+            save.close()
+
+    summary = summarize(results, wall)
+    print_summary(summary)
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
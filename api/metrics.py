@@ -0,0 +1,129 @@
+'''
+Request and phase timings in the Prometheus text format.
+
+Metrics are kept per process: with several server processes each reports its
+own, and phases of analyses running in the worker processes of workers.py
+are only seen as part of the request's latency.
+'''
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000, 100000000]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # Per label set: counts per bucket (the last one for +Inf), sum
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self.series.items()]
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                labels = format_labels(key + (('le', bound),))
+                lines.append('%s_bucket%s %d' % (self.name, labels, cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(key), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(key), cumulative))
+        return lines
+
+class Gauge:
+    def __init__(self, name, help, type='gauge'):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for key, value in series:
+            lines.append('%s%s %s' % (self.name, format_labels(key), format_value(value)))
+        return lines
+
+class Counter(Gauge):
+    def __init__(self, name, help):
+        super().__init__(name, help, type='counter')
+
+class Collector:
+    '''
+    Values read when the metrics are rendered: collect() returns a list of
+    (labels dict, value).
+    '''
+    def __init__(self, name, help, type, collect):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.collect = collect
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labels, value in self.collect():
+            lines.append('%s%s %s' % (self.name, format_labels(tuple(sorted(labels.items()))), format_value(value)))
+        return lines
+
+registry = []
+
+request_seconds = Histogram('encam_request_duration_seconds', 'Time to handle a request.', LATENCY_BUCKETS)
+response_bytes = Histogram('encam_response_size_bytes', 'Size of response bodies as sent.', SIZE_BUCKETS)
+requests_total = Counter('encam_requests_total', 'Handled requests.')
+in_flight = Gauge('encam_requests_in_flight', 'Requests being handled.')
+phase_seconds = Histogram('encam_phase_duration_seconds', 'Time spent in a phase of handling a request.', LATENCY_BUCKETS)
+
+def phase(name):
+    '''
+    Times a block as the given phase: filtering, reshape, statistics or
+    serialization.
+    '''
+    return phase_seconds.time(phase=name)
+
+def render():
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
@@ -0,0 +1,42 @@
+'''
+Responses that only depend on the loaded dataset, serialized and compressed
+once.
+
+Every payload is kept as bytes with gzip and, when the brotli package is
+installed, brotli variants. Responses carry an ETag made from the database
+version and the encoding and the dataset's modification time as
+Last-Modified, so clients and proxies revalidate them with 304s.
+'''
+import gzip
+from datetime import datetime, timezone
+from flask import make_response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Payload:
+    def __init__(self, body, mimetype, version, modified):
+        self.mimetype = mimetype
+        self.version = version
+        self.modified = datetime.fromtimestamp(modified, timezone.utc)
+        self.encodings = {
+            'identity': body,
+            'gzip': gzip.compress(body, compresslevel=9, mtime=0),
+        }
+        if brotli:
+            self.encodings['br'] = brotli.compress(body)
+
+def respond(payload, request):
+    available = [e for e in ['br', 'gzip', 'identity'] if e in payload.encodings]
+    encoding = request.accept_encodings.best_match(available, default='identity')
+    response = make_response(payload.encodings[encoding])
+    response.headers['Content-Type'] = payload.mimetype
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag('%s-%s' % (payload.version, encoding))
+    response.last_modified = payload.modified
+    return response.make_conditional(request)
@@ -0,0 +1,130 @@
+'''
+Profiles of single requests, for finding out why a filter is slow.
+
+A request is profiled with cProfile when a whitelisted session sends the
+X-Profile header, or at random with the probability set as SampleRate in the
+[PROFILING] section of config.ini. Analyses of a profiled request run in the
+request thread, also with ANALYSIS_WORKERS, so that the profile covers them.
+Only one request is profiled at a time, others run unprofiled meanwhile.
+
+Each profile is written as <name>.prof, loadable with pstats, next to a
+<name>.json with the endpoint, the request body and the time taken. The
+directory (Directory, default /tmp/encam-profiles) keeps the Keep (default
+50) most recent profiles.
+'''
+import os
+import io
+import json
+import time
+import glob
+import marshal
+import pstats
+import cProfile
+import threading
+
+import store
+import workers
+
+# cProfile can only have one profiler active at a time
+lock = threading.Lock()
+
+class Ring:
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+
+    def names(self):
+        '''
+        The stored profiles, newest first.
+        '''
+        paths = glob.glob(os.path.join(self.directory, '*.prof'))
+        return sorted((os.path.basename(p)[:-len('.prof')] for p in paths), reverse=True)
+
+    def path(self, name, ext):
+        if name not in self.names():
+            raise KeyError(name)
+        return os.path.join(self.directory, name + ext)
+
+    def save(self, profile, info):
+        os.makedirs(self.directory, exist_ok=True)
+        profile.create_stats()
+        slug = info['endpoint'].strip('/').replace('/', '_') or 'root'
+        # Names sort by time, the process id keeps server processes apart
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(info['time']))
+        name = '%s.%06d-%d-%s' % (stamp, info['time'] % 1 * 10**6, os.getpid(), slug)
+        store.atomic_write(os.path.join(self.directory, name + '.json'), json.dumps(info).encode())
+        store.atomic_write(os.path.join(self.directory, name + '.prof'), marshal.dumps(profile.stats))
+        for old in self.names()[self.keep:]:
+            for ext in ['.prof', '.json']:
+                try:
+                    os.remove(os.path.join(self.directory, old + ext))
+                except FileNotFoundError:
+                    pass
+        return name
+
+    def list(self):
+        profiles = []
+        for name in self.names():
+            try:
+                with open(os.path.join(self.directory, name + '.json')) as fp:
+                    profiles.append(dict(json.load(fp), name=name))
+            except FileNotFoundError:
+                # Removed by another process since listing
+                pass
+        return profiles
+
+    def text(self, name, limit=50):
+        '''
+        The profile as pstats prints it, by cumulative time.
+        '''
+        out = io.StringIO()
+        pstats.Stats(self.path(name, '.prof'), stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+class Request:
+    '''
+    The profile of one request, from start() to stop().
+    '''
+    def __init__(self, ring):
+        self.ring = ring
+        self.profile = None
+
+    def start(self):
+        if not lock.acquire(blocking=False):
+            return False
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        workers.local.inline = True
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return True
+
+    def stop(self, endpoint, method, body, status):
+        if self.profile is None:
+            return None
+        try:
+            self.profile.disable()
+            seconds = time.perf_counter() - self.start_time
+        finally:
+            workers.local.inline = False
+            lock.release()
+        info = {
+            'time': self.started,
+            'endpoint': endpoint,
+            'method': method,
+            'status': status,
+            'seconds': seconds,
+            'body': body,
+        }
+        name = self.ring.save(self.profile, info)
+        print('Saved profile', name, 'of', method, endpoint, 'taking', round(seconds, 3), 's')
+        self.profile = None
+        return name
+
+def from_config(config):
+    '''
+    The ring and sample rate from the [PROFILING] section of a ConfigParser.
+    '''
+    section = config['PROFILING'] if config.has_section('PROFILING') else {}
+    ring = Ring(section.get('Directory', '/tmp/encam-profiles'), int(section.get('Keep', '50')))
+    return ring, float(section.get('SampleRate', '0'))
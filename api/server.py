@@ -1,14 +1,22 @@
-from flask import Flask, request, jsonify, render_template, url_for, make_response, redirect, session
+from flask import Flask, request, jsonify, render_template, url_for, make_response, redirect, session, g, send_file
 from lifelines import CoxPHFitter
-import pandas as pd
 import json
 from flask_dance.contrib.google import make_google_blueprint, google
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError, TokenExpiredError
 import os
+import time
+import random
+import threading
 import configparser
 
 from database import db
 import database as database_lib
+import wire
+import workers
+import payloads
+import content
+import metrics
+import profiling
 
 config = configparser.ConfigParser()
 config.read('/config/config.ini')
@@ -29,6 +37,118 @@ whitelist_file = config['AUTH']['Whitelist']
 with open(whitelist_file, 'r') as file:
     whitelist = [line.strip() for line in file]
 
+profiles, profile_sample_rate = profiling.from_config(config)
+
+@app.errorhandler(workers.Busy)
+def busy(e):
+    response = jsonify({"error": "Too many analyses running, try again later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(workers.RETRY_AFTER)
+    return response
+
+@app.errorhandler(workers.Timeout)
+def timeout(e):
+    response = jsonify({"error": "Analysis timed out"})
+    response.status_code = 504
+    return response
+
+@app.before_request
+def pin_database():
+    # The whole request sees one version of the database, also during a reload
+    db.pin()
+
+@app.teardown_request
+def unpin_database(e):
+    db.unpin()
+
+@app.before_request
+def start_request_timer():
+    g.start = time.perf_counter()
+    metrics.in_flight.inc()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.request_seconds.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    metrics.requests_total.inc(endpoint=endpoint, status=response.status_code)
+    if response.content_length is not None:
+        metrics.response_bytes.observe(response.content_length, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def end_request(e):
+    metrics.in_flight.dec()
+
+# Appends the analysis requests as JSON lines that loadtest.py can replay
+request_log = os.getenv('REQUEST_LOG')
+request_log_lock = threading.Lock()
+recorded_endpoints = ['/api/configuration', '/api/database', '/api/tukey', '/api/filter', '/api/size', '/api/survival', '/api/cutpoints', '/api/expression']
+
+@app.after_request
+def record_request_body(response):
+    if request_log and request.path in recorded_endpoints and request.method in ['GET', 'POST']:
+        line = json.dumps({'method': request.method, 'path': request.path, 'body': request.get_json(silent=True)})
+        with request_log_lock, open(request_log, 'a') as fp:
+            fp.write(line + '\n')
+    return response
+
+@app.before_request
+def start_profile():
+    # Whitelisted users can ask for a profile of any request, see profiling.py
+    if (request.headers.get('X-Profile') and whitelisted()) or random.random() < profile_sample_rate:
+        g.profile = profiling.Request(profiles)
+        g.profile.start()
+
+def stop_profile(status):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        return profile.stop(endpoint, request.method, request.get_json(silent=True), status)
+
+@app.after_request
+def save_profile(response):
+    name = stop_profile(response.status_code)
+    if name:
+        response.headers['X-Profile-Name'] = name
+    return response
+
+@app.teardown_request
+def save_failed_profile(e):
+    # after_request is skipped when the view raised
+    stop_profile(500)
+
+def cache_metric(field):
+    return lambda: [
+        ({'cache': name}, cache.stats()[field])
+        for name, cache in [('cohorts', db.cohorts), ('survival', db.survival)]
+    ]
+
+metrics.Collector('encam_cache_hits_total', 'Cache hits.', 'counter', cache_metric('hits'))
+metrics.Collector('encam_cache_misses_total', 'Cache misses.', 'counter', cache_metric('misses'))
+metrics.Collector('encam_cache_evictions_total', 'Cache evictions.', 'counter', cache_metric('evictions'))
+metrics.Collector('encam_cache_coalesced_total', 'Cache misses that waited for a running computation.', 'counter', cache_metric('coalesced'))
+metrics.Collector('encam_cache_size', 'Size of the cached values.', 'gauge', cache_metric('size'))
+
+def build_payloads():
+    payload = lambda data: payloads.Payload(data, 'application/json', db.version, db.modified)
+    return {
+        'configuration': payload(wire.dumps(database_lib.configuration())),
+        'database': payload(wire.records_json(db.db).encode()),
+    }
+
+def static_payload(name):
+    # Built once per database version, kept with the version the request pinned
+    current = db.current()
+    if current.payloads is None:
+        current['payloads'] = build_payloads()
+    return current.payloads[name]
+
+static_payload('configuration')
+
+dataset_poll = float(os.getenv('DATASET_POLL', '0'))
+if dataset_poll > 0:
+    database_lib.watch_dataset(dataset_poll)
+
 @app.route('/api/')
 def root():
     """
@@ -38,7 +158,25 @@ def root():
 
 @app.route('/api/ping')
 def ping():
-    return make_response("pong", "text/plain")
+    return make_response("pong", 200, {'Content-Type': 'text/plain'})
+
+def json_response(data):
+    return app.response_class(data, mimetype='application/json')
+
+def frames_response(frames, nan='null'):
+    '''
+    One frame per request body, in the format picked by the Accept header.
+    Defaults to a list of records per body, with missing numbers as nan.
+    '''
+    mimetype = request.accept_mimetypes.best_match(wire.mimetypes(), default=wire.JSON)
+    with metrics.phase('serialization'):
+        if mimetype == wire.JSON:
+            response = json_response('[' + ','.join(wire.records_json(df, nan) for df in frames) + ']')
+        else:
+            response = make_response(wire.encode(frames, mimetype))
+            response.headers['Content-Type'] = mimetype
+    response.headers['Vary'] = 'Accept'
+    return response
 
 @app.route('/api/filter', methods=['OPTIONS', 'POST'])
 def filter():
@@ -47,14 +185,10 @@ def filter():
         # https://github.com/github/fetch/issues/143
         return jsonify({})
     elif request.is_json:
-        responses = []
         body = request.json
         # Basic filtering
-        responses = [
-            database_lib.filter(b).to_dict(orient='records')
-            for b in body
-        ]
-        return jsonify(responses)
+        frames = [database_lib.filter(b) for b in body]
+        return frames_response(frames)
     else:
         return jsonify({"error": "Body must be JSON"})
 
@@ -67,81 +201,36 @@ def tukey():
     elif request.is_json:
         body = request.json
         # Basic filtering
-        responses = [
-            database_lib.filter_to_tukey(b).fillna('NaN').to_dict(orient='records')
-            for b in body
-        ]
-        return jsonify(responses)
+        frames = workers.run_all(database_lib.filter_to_tukey, body)
+        # Missing statistics are the string NaN for the frontend
+        return frames_response(frames, nan='"NaN"')
     else:
         return jsonify({"error": "Body must be JSON"})
 
 
 @app.route('/api/configuration')
 def configuration():
-    def tidy_values(values):
-        values = sorted(values, key=lambda x: (isinstance(x, float), x))
-        values = [ 'missing' if pd.isnull(v) else v for v in values ]
-        values = database_lib.uniq(values)
-        return values
-    tumor_specific_columns = [
-        'Anatomical_location',
-        'Morphological_type',
-        'MSI_ARTUR',
-    ]
-    tumor_specific_values = []
-    for column in tumor_specific_columns:
-        # values = database_lib.uniq(data[c][lambda x: ~pd.isnull(x)])
-        # print(c, values, flush=True)
-        for tumor in db.tumor_types:
-            values = tidy_values(db.data[db.data.Tumor_type_code == tumor][column])
-            if len(values) > 1:
-                tumor_specific_values.append({
-                    'column': column,
-                    'tumor': tumor,
-                    'values': values
-                })
-    variant_columns = [
-        # 'Tumor_type_code',
-        # 'Gender',
-        # 'Anatomical_location',
-        # 'Morphological_type',
-        'clinical_stage',
-        'pT_stage',
-        'pN_stage',
-        'pM_stage',
-        'Diff_grade',
-        'Neuralinv',
-        'Vascinv',
-        'PreOp_treatment_yesno',
-        'PostOp_type_treatment',
-        # 'MSI_ARTUR',
-    ]
-    variant_values = []
-    for column in variant_columns:
-        values = tidy_values(db.data[column])
-        variant_values.append({
-            'column': column,
-            'values': values
-        })
-    config = {
-        'variant_values': variant_values,
-        'tumor_specific_values': tumor_specific_values,
-        'tumors': db.tumor_types,
-        'cells_full': db.cell_types,
-        'cells': tidy_values('_'.join(c.split('_')[:-1]) for c in db.cell_types),
-        'tumor_codes': db.codes_dict,
-    }
-    return jsonify(config)
+    return payloads.respond(static_payload('configuration'), request)
 
 @app.route('/api/codes')
 def codes():
     response = jsonify(db.codes_dict)
     return response
 
+@app.route('/api/metrics')
+def metrics_route():
+    return make_response(metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    return jsonify({
+        'cohorts': db.cohorts.stats(),
+        'survival': db.survival.stats(),
+    })
+
 @app.route('/api/database')
 def database():
-    response = jsonify(db.db.to_dict(orient='records'))
-    return response
+    return payloads.respond(static_payload('database'), request)
 
 @app.route('/api/survival', methods=['OPTIONS', 'POST'])
 def survival():
@@ -152,7 +241,21 @@ def survival():
     elif request.is_json:
         body = request.json
         response = database_lib.filter_survival(body)
-        return jsonify(response)
+        with metrics.phase('serialization'):
+            return json_response(wire.dumps(response))
+    else:
+        return jsonify({"error": "Body must be JSON"})
+
+@app.route('/api/cutpoints', methods=['OPTIONS', 'POST'])
+def cutpoints():
+    if request.method == 'OPTIONS':
+        # CORS fetch with POST+Headers starts with a pre-flight OPTIONS:
+        # https://github.com/github/fetch/issues/143
+        return jsonify({})
+    elif request.is_json:
+        body = request.json
+        response = workers.run(database_lib.cutpoints, body)
+        return json_response(wire.dumps(response))
     else:
         return jsonify({"error": "Body must be JSON"})
 
@@ -177,8 +280,8 @@ def expression():
         return jsonify({})
     elif request.is_json:
         body = request.json
-        response = database_lib.expression(body).to_list()
-        return jsonify(response)
+        response = database_lib.expression(body)
+        return json_response(wire.array_json(response.to_numpy()))
 
 def whitelisted():
     return session.get('email') in whitelist
@@ -188,34 +291,45 @@ content_files = [
     'content.staged.json',
 ]
 
-import tempfile
-import shutil
-
 def add_content_route(content_file):
     endpoint = '/api/' + content_file
-    filepath = '/config/content/' + content_file
+    document = content.Document('/config/content/' + content_file)
     @app.route(endpoint, methods=['POST', 'GET'], endpoint=endpoint)
-    def content():
+    def content_route():
         if request.method == 'GET':
-            with open(filepath) as json_file:
-                response = json.load(json_file)
-            return jsonify(response)
+            return payloads.respond(document.get(), request)
         elif request.method == 'POST':
             if not whitelisted():
                 return jsonify({"success": False, "reason": "Not on whitelist."})
             else:
-                body = request.json
-                with open(filepath, 'w') as fp:
-                    json.dump(body, fp, indent=2)
-                try:
-                    os.chmod(filepath, 0o666)
-                except PermissionError as e:
-                    print('Failed to chmod 666', filepath, ':', str(e))
+                document.put(request.json)
                 return jsonify({"success": True})
 
 for content_file in content_files:
     add_content_route(content_file)
 
+@app.route('/api/profiles')
+def list_profiles():
+    if not whitelisted():
+        return jsonify({"success": False, "reason": "Not on whitelist."})
+    return jsonify(profiles.list())
+
+@app.route('/api/profiles/<name>')
+def download_profile(name):
+    '''
+    The profile for pstats, or with ?format=text as pstats prints it.
+    '''
+    if not whitelisted():
+        return jsonify({"success": False, "reason": "Not on whitelist."})
+    try:
+        if request.args.get('format') == 'text':
+            return make_response(profiles.text(name), 200, {'Content-Type': 'text/plain'})
+        return send_file(profiles.path(name, '.prof'), as_attachment=True, attachment_filename=name + '.prof')
+    except KeyError:
+        response = jsonify({"error": "No such profile"})
+        response.status_code = 404
+        return response
+
 @app.route("/api/login")
 def login():
     '''
@@ -0,0 +1,166 @@
+'''
+Mergeable quantile summaries for approximate boxplots.
+
+Rows are split into strata by tumor type and by the base filter columns with
+the fewest values, as many of those as keep the number of strata per tumor
+type at most max_strata. A filter that keeps every value of the other filter
+columns in the tumor types it selects selects a union of whole strata, and
+is answered from their summaries. Filters on the other columns are computed
+exactly. A merge thus handles at most size points per selected stratum and
+cell column, however many patients there are.
+
+For every stratum and cell column the sorted values are cut into at most size
+chunks of equal length and each chunk is kept as its middle value weighted by
+the chunk length. Strata with at most size values keep all of them.
+
+Merging the summaries of the selected strata gives a weighted sample where the
+number of values below any threshold is off by less than one chunk per
+summarized stratum, i.e. a rank error below 1/size of each summarized
+stratum's values. Means, minima, maxima and counts are kept exactly.
+'''
+import numpy as np
+import pandas as pd
+
+import stats
+
+def categories(data, columns):
+    keys = data[columns].astype(object)
+    return keys.where(keys.notnull(), 'missing')
+
+def strata_columns(data, columns, max_strata):
+    '''
+    The columns with the fewest values whose combinations number at most
+    max_strata.
+    '''
+    chosen, combinations = [], 1
+    for column in sorted(columns, key=lambda c: (data[c].nunique(dropna=False), columns.index(c))):
+        values = data[column].nunique(dropna=False)
+        if combinations * values <= max_strata:
+            chosen.append(column)
+            combinations *= values
+    return [c for c in columns if c in chosen]
+
+def build(data, expression, base_filters, tumor_specific_filters, size, max_strata):
+    '''
+    Summaries of expression (a matrix with one column per cell column) for
+    the strata of data.
+    '''
+    columns = ['Tumor_type_code'] + strata_columns(data, base_filters, max_strata)
+    keys = categories(data, columns)
+    stratum = keys.groupby(columns, sort=False).ngroup().to_numpy()
+    strata = keys.groupby(stratum, sort=True).first().reset_index(drop=True)
+    num_strata, num_columns = len(strata), expression.shape[1]
+
+    # The values of the other filter columns per tumor type, which a filter
+    # must all keep to be answered from the summaries
+    free = [c for c in base_filters + tumor_specific_filters if c not in columns]
+    tumors = data['Tumor_type_code'].to_numpy()
+    present = {
+        column: {tumor: frozenset(values) for tumor, values in categories(data, [column])[column].groupby(tumors)}
+        for column in free
+    }
+
+    # Points column by column, ordered by stratum within a column
+    values, weights, point_strata, offsets = [], [], [], [0]
+    errors, counts, sums, mins, maxs = [], [], [], [], []
+    for j in range(num_columns):
+        v = np.asarray(expression[:, j])
+        keep = ~np.isnan(v)
+        v, s = v[keep], stratum[keep]
+        order = np.lexsort((v, s))
+        v, s = v[order], s[order]
+        n = np.bincount(s, minlength=num_strata)
+        first = np.cumsum(n) - n
+        # Chunk length per stratum, one for strata kept exactly
+        length = np.maximum(-(-n // size), 1)
+        rank = np.arange(len(v)) - first[s]
+        chunk = first[s] + rank // length[s] * length[s]
+        starts, weight = np.unique(chunk, return_counts=True)
+        values.append(v[starts + weight // 2])
+        weights.append(weight)
+        point_strata.append(s[starts])
+        offsets.append(offsets[-1] + len(starts))
+        errors.append(np.where(length > 1, length, 0))
+        counts.append(n)
+        sums.append(np.bincount(s, weights=v, minlength=num_strata))
+        mins.append(np.where(n > 0, v[np.minimum(first, len(v) - 1)], np.nan))
+        maxs.append(np.where(n > 0, v[np.maximum(first + n - 1, 0)], np.nan))
+
+    return dict(
+        size=size,
+        strata=strata,
+        free=present,
+        tumors=strata['Tumor_type_code'].to_numpy(),
+        rows=np.bincount(stratum, minlength=num_strata),
+        values=np.concatenate(values),
+        weights=np.concatenate(weights),
+        point_strata=np.concatenate(point_strata),
+        offsets=np.array(offsets),
+        errors=np.stack(errors, axis=1),
+        counts=np.stack(counts, axis=1),
+        sums=np.stack(sums, axis=1),
+        mins=np.stack(mins, axis=1),
+        maxs=np.stack(maxs, axis=1),
+    )
+
+def select(sketches, filter_id):
+    '''
+    The strata a filter selects, or None when it also drops rows by the
+    values of columns the strata are not split by.
+    '''
+    tumors = set(filter_id['tumors'])
+    for column, per_tumor in sketches['free'].items():
+        listed = filter_id[column]
+        for tumor, values in per_tumor.items():
+            if tumor not in tumors:
+                continue
+            if isinstance(listed, dict):
+                # Tumor specific values, which only filter when given
+                if tumor in listed and not values <= set(listed[tumor]):
+                    return None
+            elif not values <= set(listed):
+                return None
+
+    strata = sketches['strata']
+    selected = strata['Tumor_type_code'].isin(filter_id['tumors'])
+    for column in strata.columns[1:]:
+        selected &= strata[column].isin(filter_id[column])
+    return np.flatnonzero(selected.to_numpy())
+
+def tukey(sketches, strata, columns):
+    '''
+    Approximate statistics for the given strata and cell columns, in the row
+    order of filter_to_tukey before sorting (tumor by tumor in order of
+    appearance, then by column). Returns the statistics, with per row the
+    rank_error bound as a fraction of the group size, and the tumors.
+    '''
+    tumor_codes, tumors = pd.factorize(sketches['tumors'][strata])
+    num_groups = len(tumors) * len(columns)
+
+    # First output group of every selected stratum, -1 for the others
+    target = np.full(len(sketches['tumors']), -1)
+    target[strata] = tumor_codes * len(columns)
+    values, groups, weights = [], [], []
+    for k, j in enumerate(columns):
+        points = slice(sketches['offsets'][j], sketches['offsets'][j + 1])
+        group = target[sketches['point_strata'][points]]
+        keep = group >= 0
+        values.append(sketches['values'][points][keep])
+        groups.append(group[keep] + k)
+        weights.append(sketches['weights'][points][keep])
+    res = stats.tukey(np.concatenate(values), np.concatenate(groups), num_groups, weights=np.concatenate(weights))
+
+    # Exact aggregates of the selected strata
+    group = (tumor_codes[:, None] * len(columns) + np.arange(len(columns))).ravel()
+    merged = lambda name: sketches[name][np.ix_(strata, columns)].ravel()
+    sum_up = lambda name: np.bincount(group, weights=merged(name), minlength=num_groups)
+    count = sum_up('counts')
+    nonempty = count > 0
+    lo, hi = np.full(num_groups, np.nan), np.full(num_groups, np.nan)
+    np.fmin.at(lo, group, merged('mins'))
+    np.fmax.at(hi, group, merged('maxs'))
+    res.loc[nonempty, 'mean'] = sum_up('sums')[nonempty] / count[nonempty]
+    res['min'], res['max'] = lo, hi
+    error = sum_up('errors')
+    res['rank_error'] = np.divide(error, count, out=np.zeros(num_groups), where=nonempty).clip(max=1)
+    return res, tumors
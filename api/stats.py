@@ -0,0 +1,424 @@
+'''
+Vectorized statistics used by database.py.
+
+These reimplement the parts of lifelines and the per group NumPy code that
+the api calls in hot loops, operating directly on NumPy arrays for all
+models or groups at once.
+'''
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2, norm
+
+def tie_groups(T):
+    '''
+    Given sorted times, returns the start index of each run of tied times
+    and for every row the index of its run.
+    '''
+    starts = np.flatnonzero(np.r_[True, T[1:] != T[:-1]])
+    group = np.cumsum(np.r_[True, T[1:] != T[:-1]]) - 1
+    return starts, group
+
+def coxph_univariate(T, E, X, names=None, alpha=0.05, max_iter=50, precision=1e-9):
+    '''
+    Fits one single-covariate Cox proportional hazards model per column of X,
+    all at once, with Efron's tie handling (the lifelines default).
+
+    Rows with a missing covariate are left out of that column's model only.
+    All models share one sort by time, so the risk sets are reverse cumulative
+    sums over the same row order with a per-column weight mask.
+
+    Returns a DataFrame indexed by names with the columns coef, lower, upper, p
+    (hazard ratio, its confidence interval and the Wald p-value) and a boolean
+    column converged. Non-converged rows are NaN and should be refitted some
+    other way.
+    '''
+    T = np.asarray(T, dtype=float)
+    E = np.asarray(E, dtype=float)
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    n, k = X.shape
+    if names is None:
+        names = list(range(k))
+
+    order = np.argsort(T, kind='stable')
+    T, E, X = T[order], E[order], X[order]
+    W = ~np.isnan(X) & ~np.isnan(T)[:, None] & ~np.isnan(E)[:, None]
+    E = np.nan_to_num(E)
+
+    # Centering does not change the partial likelihood but keeps exp() in range
+    count = W.sum(axis=0)
+    mean = np.where(W, X, 0).sum(axis=0) / np.maximum(count, 1)
+    x = np.where(W, X - mean, 0.0)
+
+    starts, group = tie_groups(T)
+    dE = W * E[:, None]
+    d = np.add.reduceat(dE, starts)[group]
+    # Efron: the l:th tied death at a time removes l/d of the tied deaths' risk
+    before = np.cumsum(dE, axis=0) - dE
+    l = before - before[starts][group]
+    frac = np.divide(l, d, out=np.zeros_like(l), where=d > 0)
+
+    def evaluate(beta):
+        r = W * np.exp(beta * x)
+        rx = r * x
+        rxx = rx * x
+        risk = lambda a: np.cumsum(a[::-1], axis=0)[::-1][starts][group]
+        tied = lambda a: np.add.reduceat(a * dE, starts)[group]
+        phi0 = risk(r) - frac * tied(r)
+        phi1 = risk(rx) - frac * tied(rx)
+        phi2 = risk(rxx) - frac * tied(rxx)
+        phi0 = np.where(dE > 0, phi0, 1.0)
+        m1 = phi1 / phi0
+        loglik = (dE * (beta * x - np.log(phi0))).sum(axis=0)
+        grad = (dE * (x - m1)).sum(axis=0)
+        hess = -(dE * (phi2 / phi0 - m1 ** 2)).sum(axis=0)
+        return loglik, grad, hess
+
+    beta = np.zeros(k)
+    loglik, grad, hess = evaluate(beta)
+    converged = np.zeros(k, dtype=bool)
+    for _ in range(max_iter):
+        active = ~converged & (hess < 0)
+        if not active.any():
+            break
+        delta = np.where(active, -grad / np.where(hess < 0, hess, -1.0), 0.0)
+        step = np.ones(k)
+        # Halve the step for columns where the likelihood did not improve
+        for _ in range(30):
+            new_beta = beta + step * delta
+            new_loglik, new_grad, new_hess = evaluate(new_beta)
+            worse = active & ~(new_loglik >= loglik - 1e-12)
+            if not worse.any():
+                break
+            step = np.where(worse, step / 2, step)
+        beta = np.where(active, new_beta, beta)
+        loglik = np.where(active, new_loglik, loglik)
+        grad = np.where(active, new_grad, grad)
+        hess = np.where(active, new_hess, hess)
+        converged |= active & (np.abs(step * delta) < precision)
+
+    se = np.sqrt(-1 / np.where(hess < 0, hess, np.nan))
+    converged &= np.isfinite(beta) & np.isfinite(se)
+    z = norm.ppf(1 - alpha / 2)
+    summary = pd.DataFrame({
+        'coef': np.exp(beta),
+        'lower': np.exp(beta - z * se),
+        'upper': np.exp(beta + z * se),
+        'p': chi2.sf((beta / se) ** 2, 1),
+    }, index=pd.Index(names, name='covariate'))
+    summary[~converged] = np.nan
+    summary['converged'] = converged
+    return summary
+
+def sorted_quantile(at, counts, q):
+    '''
+    The q:th quantile of each group of a sorted array, where at(ranks) gives
+    the value with the given rank in each group and counts are the group
+    sizes. Linear interpolation with the same floating point
+    operations as np.quantile.
+    '''
+    alpha = beta = 1
+    virtual = counts * q + (alpha + q * (1 - alpha - beta)) - 1
+    previous = np.clip(np.floor(virtual).astype(np.int64), 0, counts - 1)
+    following = np.clip(previous + 1, 0, counts - 1)
+    gamma = virtual - np.floor(virtual)
+    a = at(previous)
+    b = at(following)
+    diff = b - a
+    return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+def tukey(values, groups, num_groups, weights=None):
+    '''
+    Boxplot statistics of values per group, computed for all groups at once.
+
+    groups holds a group number below num_groups for every value, and NaN
+    values are left out. Returns a DataFrame with one row per group number
+    with the columns of database.Tukey_array. Groups without values get NaN
+    statistics and no outliers.
+
+    With integer weights every value counts as that many copies of itself,
+    which is how merged quantile summaries are evaluated.
+    '''
+    values = np.asarray(values, dtype=float)
+    groups = np.asarray(groups)
+    weights = np.ones(len(values), dtype=np.int64) if weights is None else np.asarray(weights)
+    present = ~np.isnan(values)
+    values, groups, weights = values[present], groups[present], weights[present]
+    order = np.lexsort((values, groups))
+    values, groups, weights = values[order], groups[order], weights[order]
+
+    # Group sizes and starts, both in points and in weighted ranks
+    points = np.bincount(groups, minlength=num_groups)
+    starts = np.cumsum(points) - points
+    counts = np.bincount(groups, weights=weights, minlength=num_groups).astype(np.int64)
+    cumulative = np.cumsum(weights)
+    nonempty = counts > 0
+    stat = lambda: np.full(num_groups, np.nan)
+
+    s, n = starts[nonempty], counts[nonempty]
+    if (weights == 1).all():
+        at = lambda rank: values[s + rank]
+    else:
+        base = (cumulative - weights)[s]
+        at = lambda rank: values[np.searchsorted(cumulative, base + rank, side='right')]
+
+    q1, q3, median, mean, lower, upper, lo, hi = (stat() for _ in range(8))
+    q1[nonempty] = sorted_quantile(at, n, 0.25)
+    q3[nonempty] = sorted_quantile(at, n, 0.75)
+    # np.median averages the two middle values of even sized groups
+    median[nonempty] = (at((n - 1) // 2) + at(n // 2)) / 2
+    mean[nonempty] = np.bincount(groups, weights=values * weights, minlength=num_groups)[nonempty] / n
+    lo[nonempty] = values[s]
+    hi[nonempty] = values[s + points[nonempty] - 1]
+
+    iqr15 = 1.5 * np.subtract(q3, q1)
+    inside_lower = values > (q1 - iqr15)[groups]
+    inside_upper = values < (q3 + iqr15)[groups]
+    # Runs are sorted, so the values inside each fence are a suffix (lower)
+    # or a prefix (upper) of the run
+    num_lower = np.bincount(groups[inside_lower], minlength=num_groups)
+    num_upper = np.bincount(groups[inside_upper], minlength=num_groups)
+    has_lower, has_upper = num_lower > 0, num_upper > 0
+    lower[has_lower] = values[(starts + points - num_lower)[has_lower]]
+    upper[has_upper] = values[(starts + num_upper - 1)[has_upper]]
+
+    outliers = lambda mask: np.bincount(groups[mask], weights=weights[mask], minlength=num_groups)
+    return pd.DataFrame({
+        'mean': mean,
+        'median': median,
+        'q1': q1,
+        'q3': q3,
+        'lower': lower,
+        'upper': upper,
+        'lower_outliers': outliers(values < lower[groups]),
+        'upper_outliers': outliers(values > upper[groups]),
+        'min': lo,
+        'max': hi,
+    })
+
+def event_table(T, E, groups, num_groups, strata=None):
+    '''
+    Removals and deaths per group at every distinct time, the one sort that
+    kaplan_meier and logrank share.
+
+    groups holds a group number below num_groups for every row. With strata
+    (integer codes per row) times are distinct within each stratum and the
+    at risk counts restart in every stratum. Each stratum starts with an
+    empty row at min(0, its first time), where Kaplan-Meier curves start.
+
+    Returns a dict with, per table row sorted by stratum and time, stratum and
+    time, the rows x groups arrays removed, deaths and at_risk (at risk just
+    before the time), and row and group, the table row and group of every
+    input row.
+    '''
+    T = np.asarray(T, dtype=float)
+    E = np.asarray(E, dtype=bool)
+    groups = np.asarray(groups)
+    strata = np.zeros(len(T), dtype=np.int64) if strata is None else np.asarray(strata)
+    n = len(T)
+
+    first = np.full(strata.max() + 1 if n else 0, np.inf)
+    np.minimum.at(first, strata, T)
+    present = np.flatnonzero(np.isfinite(first))
+    times = np.r_[T, np.minimum(first[present], 0)]
+    stratum = np.r_[strata, present]
+
+    order = np.lexsort((times, stratum))
+    new = np.r_[True, (np.diff(times[order]) != 0) | (np.diff(stratum[order]) != 0)]
+    row = np.empty(len(order), dtype=np.int64)
+    row[order] = np.cumsum(new) - 1
+    starts = np.flatnonzero(new)
+    row = row[:n]
+
+    removed = np.zeros((len(starts), num_groups))
+    deaths = np.zeros((len(starts), num_groups))
+    np.add.at(removed, (row, groups), 1)
+    np.add.at(deaths, (row, groups), E)
+
+    # At risk are all of the stratum not removed at an earlier time
+    stratum = stratum[order][starts]
+    segments = np.flatnonzero(np.r_[True, stratum[1:] != stratum[:-1]])
+    ends = np.r_[segments[1:], len(starts)]
+    cumulative = np.cumsum(removed, axis=0)
+    before = cumulative - removed
+    total = cumulative[ends - 1] - before[segments]
+    offset = np.repeat(np.arange(len(segments)), ends - segments)
+    at_risk = total[offset] - (before - before[segments][offset])
+
+    return dict(
+        stratum=stratum,
+        time=times[order][starts],
+        removed=removed,
+        deaths=deaths,
+        at_risk=at_risk,
+        row=row,
+        group=groups,
+    )
+
+def kaplan_meier(table, alpha=0.05):
+    '''
+    Kaplan-Meier curves for every group of an unstratified event_table, with
+    exponential Greenwood confidence bands, computed like lifelines'
+    KaplanMeierFitter.
+
+    Returns a DataFrame with the columns group, time, fit, lower and upper,
+    one row per group and time where the group has rows (plus the start time)
+    sorted by group and time, and for every input row of the table the index
+    of its curve row, which is where the curve is evaluated at its time.
+    '''
+    population, deaths = table['at_risk'], table['deaths']
+    # Curve rows of each group; other times leave the sums below unchanged
+    curve = (table['removed'] > 0) | (np.arange(len(population)) == 0)[:, None]
+    curve &= table['removed'].sum(axis=0) > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = np.where(curve, np.log(population - deaths) - np.log(population), 0.0)
+        var = deaths / (population * (population - deaths))
+        var = np.where(curve & ~np.isinf(var), var, 0.0)
+        log_estimate = np.cumsum(f, axis=0).T[curve.T]
+        cumulative_sq = np.cumsum(var, axis=0).T[curve.T]
+        fit = np.exp(log_estimate)
+        z = norm.ppf(1 - alpha / 2)
+        v = np.log(fit)
+        lower = np.exp(-np.exp(np.log(-v) - z * np.sqrt(cumulative_sq) / v))
+        upper = np.exp(-np.exp(np.log(-v) + z * np.sqrt(cumulative_sq) / v))
+
+    group, row = np.nonzero(curve.T)
+    curves = pd.DataFrame({
+        'group': group,
+        'time': table['time'][row],
+        'fit': fit,
+        'lower': np.where(np.isnan(lower), 1.0, lower),
+        'upper': np.where(np.isnan(upper), 1.0, upper),
+    })
+    position = (np.cumsum(curve.T.ravel()) - 1).reshape(curve.T.shape)
+    return curves, position[table['group'], table['row']]
+
+def logrank(table):
+    '''
+    Log-rank test of equal survival of the groups of an event_table with at
+    least one row, stratified if the table is. Computed like lifelines'
+    multivariate_logrank_test. Returns the test statistic, the p-value and
+    the degrees of freedom.
+    '''
+    present = table['removed'].sum(axis=0) > 0
+    n_j = table['at_risk'][:, present]
+    d_j = table['deaths'][:, present]
+    n, d = n_j.sum(axis=1), d_j.sum(axis=1)
+    k = n_j.shape[1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z = d_j.sum(axis=0) - (n_j * (d / n)[:, None]).sum(axis=0)
+        factor = (n - d) / (n - 1)
+        factor = np.where(np.isfinite(factor), factor, 1) * d / n ** 2
+    V = np.diag((factor * n) @ n_j) - (n_j * factor[:, None]).T @ n_j
+
+    statistic = Z[:-1] @ np.linalg.pinv(V[:-1, :-1]) @ Z[:-1]
+    return statistic, chi2.sf(statistic, k - 1), k - 1
+
+def dominance_sums(rank, weights):
+    '''
+    For every position k, the number and the sum of weights of the earlier
+    positions j < k with rank[j] <= rank[k].
+
+    Bottom-up merge sort: at every level the positions are in sorted runs of
+    width w, and the positions of every odd run look up the even run before
+    it, all runs at once with one searchsorted. O(n log n) without a Python
+    loop over the rows.
+    '''
+    rank = np.asarray(rank, dtype=np.int64)
+    weights = np.asarray(weights, dtype=float)
+    n = len(rank)
+    span = rank.max() + 1 if n else 1
+    count, total = np.zeros(n), np.zeros(n)
+    # Positions, sorted by rank within each run of width w
+    perm = np.arange(n)
+    w = 1
+    while w < n:
+        run = perm // w
+        ranks = rank[perm]
+        left = run % 2 == 0
+        right = ~left & (run > 0)
+        left_keys = (run * span + ranks)[left]
+        left_cum = np.r_[0, np.cumsum(weights[perm][left])]
+        # The run before each right position, and where it starts
+        before = (run[right] - 1) * span
+        start = np.searchsorted(left_keys, before, side='left')
+        end = np.searchsorted(left_keys, before + ranks[right], side='right')
+        count[perm[right]] += end - start
+        total[perm[right]] += left_cum[end] - left_cum[start]
+        w *= 2
+        perm = perm[np.argsort((perm // w) * span + rank[perm], kind='stable')]
+    return count, total
+
+def cutpoints(x, T, E, min_fraction=0.1):
+    '''
+    Two group log-rank tests for every cutpoint of x, splitting the rows
+    into a low group x < cutpoint and a high group, like binning() in
+    database.py does. Cutpoints are the distinct values of x for which both
+    groups have at least min_fraction of the rows.
+
+    Moving rows one by one into the low group, the log-rank score of the low
+    group is a prefix sum of e - A(T), with A the Nelson-Aalen estimate of
+    the whole cohort. The variance has a part that is a prefix sum too and a
+    part summing over pairs of low rows, which dominance_sums gives for all
+    cutpoints in O(n log n).
+
+    Returns a DataFrame with per cutpoint the sizes of the groups, the
+    log-rank statistic and p-value and the hazard ratio of the high group
+    relative to the low group as estimated by (O/E high) / (O/E low).
+    '''
+    x = np.asarray(x, dtype=float)
+    T = np.asarray(T, dtype=float)
+    E = np.asarray(E, dtype=float)
+    n = len(x)
+
+    # Per distinct time: deaths d, at risk r and the cumulative sums
+    times, rank = np.unique(T, return_inverse=True)
+    d = np.bincount(rank, weights=E)
+    r = n - np.r_[0, np.cumsum(np.bincount(rank))[:-1]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(r > 1, d * (r - d) / (r - 1), 0.0)
+    A = np.cumsum(d / r)[rank]
+    B = np.cumsum(w / r)[rank]
+    C = np.cumsum(w / r ** 2)[rank]
+
+    order = np.argsort(x, kind='stable')
+    score = np.cumsum((E - A)[order])
+    expected = np.cumsum(A[order])
+    observed = np.cumsum(E[order])
+    linear = np.cumsum(B[order])
+
+    # Sum over pairs i, j of low rows of C(min(T_i, T_j)), as each row adds
+    # twice its pairs with the earlier rows and itself
+    r, c = rank[order], C[order]
+    below, below_sum = dominance_sums(r, c)
+    pairs = np.cumsum(2 * (below_sum + (np.arange(n) - below) * c) + c)
+
+    # Cut after the last row of each run of tied values
+    low = np.flatnonzero(np.r_[x[order][1:] != x[order][:-1], False]) + 1
+    low = low[(low >= np.ceil(min_fraction * n)) & (n - low >= np.ceil(min_fraction * n))]
+    k = low - 1
+    variance = linear[k] - pairs[k]
+    statistic = score[k] ** 2 / variance
+    deaths = observed[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazard_ratio = ((deaths - observed[k]) / (deaths - expected[k])) / (observed[k] / expected[k])
+    return pd.DataFrame({
+        'cutpoint': x[order][low],
+        'size_low': low,
+        'size_high': n - low,
+        'statistic': statistic,
+        'p': chi2.sf(statistic, 1),
+        'hazard_ratio': hazard_ratio,
+    })
+
+def maxstat_p(statistic, min_fraction):
+    '''
+    Lausen and Schumacher's (1992) approximate p-value for the largest of
+    the two group log-rank statistics over cutpoints between the
+    min_fraction and 1 - min_fraction quantiles.
+    '''
+    b = np.sqrt(statistic)
+    p = norm.pdf(b) * (b - 1 / b) * np.log((1 - min_fraction) ** 2 / min_fraction ** 2) + 4 * norm.pdf(b) / b
+    return float(np.clip(p, 0, 1))
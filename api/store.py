@@ -0,0 +1,100 @@
+'''
+On-disk cache of the built database.
+
+Entries are named after the schema version and a hash of the dataset file,
+so a changed dataset or a bumped version never picks up a stale entry.
+Each entry is a directory that is written under a temporary name and renamed
+into place, and only one process at a time builds a missing entry, the
+others wait and then load it.
+'''
+import fcntl
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def entry_key(dataset, version):
+    return '%s-%s' % (version, file_digest(dataset)[:16])
+
+def atomic_write(path, data, mode=None):
+    '''
+    Writes bytes to path so that readers see either the old or the new file.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+@contextmanager
+def locked(directory):
+    with open(os.path.join(directory, '.lock'), 'w') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def prune(directory, keep):
+    entries = sorted(glob.glob(os.path.join(directory, 'db-*')), key=os.path.getmtime, reverse=True)
+    for path in entries[keep:]:
+        # Processes that still map files from the entry keep their pages
+        print('Removing old cache entry', path, flush=True)
+        shutil.rmtree(path, ignore_errors=True)
+
+def save_pickle(path, db):
+    with open(os.path.join(path, 'db.pickle'), 'wb') as fp:
+        pickle.dump(db, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_pickle(path):
+    with open(os.path.join(path, 'db.pickle'), 'rb') as fp:
+        return pickle.load(fp)
+
+def load_or_create(dataset, version, create, directory, save=save_pickle, load=load_pickle, keep=2):
+    '''
+    Returns (key, db) for the dataset, calling create() to build db if the
+    cache has no entry for this dataset and version yet.
+
+    save(path, db) writes db to the entry directory path and load(path)
+    reads it back. At most keep entries are left in the directory.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    key = entry_key(dataset, version)
+    path = os.path.join(directory, 'db-%s' % key)
+    if os.path.isdir(path):
+        print('Loading cache entry', path, flush=True)
+        return key, load(path)
+    with locked(directory):
+        # Another process may have built it while we waited for the lock
+        if not os.path.isdir(path):
+            db = create()
+            print('Saving cache entry', path, flush=True)
+            tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+            try:
+                save(tmp, db)
+                os.chmod(tmp, 0o755)
+                os.rename(tmp, path)
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            prune(directory, keep)
+    print('Loading cache entry', path, flush=True)
+    return key, load(path)
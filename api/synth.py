@@ -0,0 +1,168 @@
+'''
+Synthetic cohorts with the columns of the dataset, for load testing with
+many more patients than SIM.csv has.
+
+    python synth.py --patients 1000000 --out big.csv
+    DATASET=big.csv uwsgi --http :9090 --mount /=server:app --threads=8
+
+learn() takes per tumor type marginals from a dataset: the frequencies of
+the values of every clinical column, the missing fraction and quantiles of
+every cell column, and the quantiles of the follow-up time of the patients
+with each status at last follow-up, missing included. generate() draws patients from them
+independently, a chunk at a time, so the output never is in memory as a
+whole, and writes a csv or, when the path ends in .parquet and pyarrow is
+installed, a parquet file. The same seed and chunk size give the same file.
+
+The columns are those of the dataset plus the names init() reads from files
+other than ./SIM.csv (MSI, clinicl_stge, Atomical_location).
+'''
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TIME = 'Time_Diagnosis_Last_followup'
+EVENT = 'Event_last_followup'
+
+# Columns init() reads under other names from datasets other than ./SIM.csv
+ALIASES = {
+    'MSI': 'MSI_ARTUR',
+    'clinicl_stge': 'clinical_stage',
+    'Atomical_location': 'Anatomical_location',
+}
+
+def is_cell(column):
+    return 'TUMOR' in column or 'STROMA' in column
+
+def quantiles(values, num_quantiles):
+    return np.quantile(values, np.linspace(0, 1, num_quantiles)) if len(values) else np.zeros(num_quantiles)
+
+def frequencies(values):
+    counts = values.value_counts(dropna=False)
+    return list(counts.index), (counts / counts.sum()).to_numpy()
+
+def learn(data, num_quantiles=257):
+    '''
+    The per tumor type marginals of a dataset as read from its csv.
+    '''
+    cells = [c for c in data.columns if is_cell(c)]
+    clinical = [c for c in data.columns if c not in cells and c not in ['Pat_ID', 'Tumor_type_code', TIME]]
+    tumors, tumor_p = frequencies(data.Tumor_type_code)
+    model = {
+        'columns': list(data.columns),
+        'integer_time': pd.api.types.is_integer_dtype(data[TIME]),
+        'tumors': tumors,
+        'tumor_p': tumor_p,
+        'per_tumor': {},
+    }
+    for tumor, group in data.groupby('Tumor_type_code'):
+        # Per event value, missing events included, with the times of the
+        # whole tumor type for values without any times
+        pooled = group[TIME].dropna()
+        times = []
+        for event in group[EVENT].unique():
+            observed = group[TIME][same_event(group[EVENT], event)].dropna()
+            times.append((event, quantiles(observed if len(observed) else pooled, num_quantiles)))
+        model['per_tumor'][tumor] = {
+            'clinical': {c: frequencies(group[c]) for c in clinical},
+            'cells': {
+                c: (group[c].isna().mean(), quantiles(group[c].dropna(), num_quantiles))
+                for c in cells
+            },
+            'times': times,
+        }
+    return model
+
+def same_event(events, event):
+    return pd.isna(events) if pd.isna(event) else events == event
+
+def draw(rng, qs, size):
+    # Inverse of the piecewise linear distribution function through the quantiles
+    return np.interp(rng.random(size), np.linspace(0, 1, len(qs)), qs)
+
+def sample(model, size, rng, first_id=1):
+    '''
+    size patients as a DataFrame in the output column layout.
+    '''
+    tumor_codes = rng.choice(len(model['tumors']), size, p=model['tumor_p'])
+    columns = {}
+    for code, tumor in enumerate(model['tumors']):
+        rows = np.flatnonzero(tumor_codes == code)
+        if len(rows) == 0:
+            continue
+        marginals = model['per_tumor'][tumor]
+        for column, (values, p) in marginals['clinical'].items():
+            picked = np.empty(len(values), dtype=object)
+            picked[:] = values
+            columns.setdefault(column, np.empty(size, dtype=object))[rows] = picked[rng.choice(len(values), len(rows), p=p)]
+        for column, (missing, qs) in marginals['cells'].items():
+            values = draw(rng, qs, len(rows))
+            values[rng.random(len(rows)) < missing] = np.nan
+            columns.setdefault(column, np.empty(size))[rows] = values
+        times = columns.setdefault(TIME, np.full(size, np.nan))
+        events = columns[EVENT][rows]
+        for event, qs in marginals['times']:
+            alike = rows[same_event(events, event)]
+            times[alike] = draw(rng, qs, len(alike))
+
+    columns['Pat_ID'] = np.arange(first_id, first_id + size)
+    columns['Tumor_type_code'] = np.array(model['tumors'], dtype=object)[tumor_codes]
+    if model['integer_time']:
+        columns[TIME] = np.round(columns[TIME]).astype(np.int64)
+    df = pd.DataFrame({c: columns[c] for c in model['columns']})
+    for alias, column in ALIASES.items():
+        if alias not in df and column in df:
+            df[alias] = df[column]
+    return df
+
+def generate(model, patients, path, seed=0, chunk_size=100000):
+    '''
+    Writes patients synthetic patients to path, chunk_size at a time.
+    '''
+    rng = np.random.default_rng(seed)
+    parquet = path.endswith('.parquet')
+    if parquet and pyarrow is None:
+        raise RuntimeError('Writing parquet needs the pyarrow package')
+    writer = None
+    try:
+        for start in range(0, patients, chunk_size):
+            df = sample(model, min(chunk_size, patients - start), rng, first_id=start + 1)
+            if parquet:
+                if writer is None:
+                    # From the dtypes, as a chunk can lack all values of a column
+                    schema = pyarrow.schema([
+                        (c, pyarrow.string() if df[c].dtype == object else pyarrow.from_numpy_dtype(df[c].dtype))
+                        for c in df.columns
+                    ])
+                    writer = pyarrow.parquet.ParquetWriter(path, schema)
+                writer.write_table(pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False))
+            else:
+                df.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    finally:
+        if writer is not None:
+            writer.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--dataset', default=os.getenv('DATASET', './SIM.csv'), help='dataset to learn from (default $DATASET or ./SIM.csv)')
+    parser.add_argument('--patients', type=int, required=True, help='number of patients to generate')
+    parser.add_argument('--out', required=True, help='output .csv or .parquet file')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='patients generated at a time (default 100000)')
+    args = parser.parse_args(argv)
+
+    data = pd.read_parquet(args.dataset) if args.dataset.endswith('.parquet') else pd.read_csv(args.dataset)
+    model = learn(data.fillna(np.nan))
+    generate(model, args.patients, args.out, args.seed, args.chunk_size)
+    print('Wrote', args.patients, 'patients to', args.out)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -422,3 +422,761 @@ except AssertionError as e:
     pass
 else:
     raise RuntimeError("Should fail, group sizes not on boundary")
+
+
+import numpy as np
+import stats
+from lifelines import CoxPHFitter
+
+# Test the batched Cox engine against lifelines fitted to convergence
+def test_coxph_univariate(tumor):
+    dd = db.db.data[db.db.data.Tumor_type_code == tumor].copy()
+    cells = db.db.cell_types
+    for c in cells:
+        dd[c] = db.ntiles(dd[c])
+    batched = stats.coxph_univariate(dd['T'], dd['E'], dd[cells], names=cells)
+    assert batched.converged.all()
+    for c in cells:
+        dd_c = dd[[c, 'T', 'E']].dropna()
+        cph = CoxPHFitter().fit(dd_c, 'T', event_col='E', fit_options={'precision': 1e-12})
+        expected = cph.summary.loc[c, ['exp(coef)', 'exp(coef) lower 95%', 'exp(coef) upper 95%', 'p']]
+        assert np.allclose(batched.loc[c, ['coef', 'lower', 'upper', 'p']].astype(float), expected, rtol=1e-4)
+
+test_coxph_univariate('COAD')
+test_coxph_univariate('OVNSA')
+
+
+# Test the bitmap index against scanning the columns like filtering used to
+def filtering_scan(filter_id):
+    data_filtered = db.db.data.fillna('missing')
+    data_filtered = data_filtered[lambda row: row.Tumor_type_code.isin(filter_id['tumors'])]
+    for key in db.base_filters:
+        data_filtered = data_filtered[data_filtered[key].isin(filter_id[key])]
+    for specific in db.tumor_specific_filters:
+        for tumor, values in filter_id[specific].items():
+            data_filtered = data_filtered[lambda row: (row.Tumor_type_code != tumor) | row[specific].isin(values)]
+    return data_filtered
+
+def test_filtering_index(ex):
+    expected = filtering_scan(ex)
+    actual = db.filtering(ex)
+    assert list(actual.index) == list(expected.index)
+    assert actual.astype(str).equals(expected.astype(str))
+
+test_filtering_index(example_body)
+test_filtering_index(example_body2)
+
+ex = deepcopy(example_body)
+ex['tumors'] = db.db.tumor_types
+ex['Anatomical_location']['COAD'] = ['Rectum', 'missing']
+ex['MSI_ARTUR'] = {'COAD': ['MSS'], 'READ': []}
+test_filtering_index(ex)
+
+# Test that reordered and irrelevant parts of a filter hit the same cached rows
+def test_canonical_filter(ex):
+    ex2 = deepcopy(ex)
+    ex2['tumors'] = list(reversed(ex2['tumors'])) + ex2['tumors'][:1]
+    ex2['pT_stage'] = list(reversed(ex2['pT_stage']))
+    ex2['cells'] = ['CD4']
+    ex2['Morphological_type']['LUAD'] = ['mucinous']
+    assert db.canonical_filter(ex) == db.canonical_filter(ex2)
+    ex3 = deepcopy(ex)
+    ex3['pT_stage'] = ex3['pT_stage'][1:]
+    assert db.canonical_filter(ex) != db.canonical_filter(ex3)
+
+    hits = db.db.cohorts.stats()['hits']
+    db.filtering(ex)
+    db.filtering(ex2)
+    assert db.db.cohorts.stats()['hits'] >= hits + 1
+
+test_canonical_filter(example_body)
+test_canonical_filter(example_body2)
+
+from cache import LRUCache
+
+def test_lru_cache():
+    c = LRUCache(10, len)
+    c.put('a', 'xxxx')
+    c.put('b', 'xxxx')
+    assert c.get('a') == 'xxxx'
+    c.put('c', 'xxxx')
+    assert c.get('b') is None
+    assert c.get('a') == 'xxxx'
+    c.put('d', 'x' * 11)
+    assert c.get('d') is None
+    assert c.stats()['evictions'] == 1
+    assert c.stats()['size'] == 8
+
+test_lru_cache()
+
+# Test the vectorized Tukey statistics against Tukey_array per group
+def test_tukey(ex):
+    df_long = filter(ex)
+    expected = db.Tukey_grouped_series(df_long.groupby(['tumor', 'cell', 'location']).expression).reset_index()
+    actual = db.filter_to_tukey(ex)
+    assert list(actual.columns) == list(expected.columns)
+    assert actual[['tumor', 'cell', 'location']].equals(expected[['tumor', 'cell', 'location']])
+    for c in actual.columns[3:]:
+        assert np.allclose(actual[c].astype(float), expected[c].astype(float), rtol=1e-12, equal_nan=True), c
+
+test_tukey(example_body)
+test_tukey(example_body2)
+
+import sketch
+import bench
+
+# Approximate Tukey statistics from small quantile summaries stay within
+# their stated rank error of the exact ones
+def test_tukey_sketch(ex):
+    db.db['sketches'] = sketch.build(db.db.data, db.db.expression, db.base_filters, db.tumor_specific_filters, 2, 16)
+    db.db['sketch_min_rows'] = 0
+    ex = dict(ex, approximate=True)
+    approx = db.filter_to_tukey(ex)
+    exact = db.filter_to_tukey(dict(ex, approximate=False))
+    del db.db['sketches']
+    long = filter(ex)
+    long = long[long.expression != 'missing']
+    assert approx[['tumor', 'cell', 'location']].equals(exact[['tumor', 'cell', 'location']])
+    assert approx.rank_error.max() > 0
+    for c in ['mean', 'min', 'max']:
+        assert np.allclose(approx[c], exact[c], equal_nan=True), c
+    for (_, row), (_, group) in zip(approx.iterrows(), long.groupby(['tumor', 'cell', 'location'])):
+        values = group.expression.to_numpy(dtype=float)
+        slack = row.rank_error + 1 / len(values)
+        for q, c in [(0.25, 'q1'), (0.5, 'median'), (0.75, 'q3')]:
+            assert np.mean(values < row[c]) - slack <= q <= np.mean(values <= row[c]) + slack, c
+
+everyone = dict(bench.bodies()['all'], cells=example_body['cells'])
+test_tukey_sketch(everyone)
+test_tukey_sketch(dict(everyone, tumors=['COAD', 'READ']))
+
+# Strata are few, and filters on the columns they are not split by are exact
+def test_tukey_sketch_strata(ex):
+    sketches = sketch.build(db.db.data, db.db.expression, db.base_filters, db.tumor_specific_filters, 2, 16)
+    assert len(sketches['strata']) <= 16 * db.db.data.Tumor_type_code.nunique()
+    split = list(sketches['strata'].columns[1:])
+    assert split and len(split) < len(db.base_filters)
+    assert sketch.select(sketches, ex) is not None
+    # Dropping a value of a stratum column selects fewer strata
+    column = split[0]
+    fewer = dict(ex, **{column: list(sketches['strata'][column].unique()[1:])})
+    assert len(sketch.select(sketches, fewer)) < len(sketch.select(sketches, ex))
+    # Dropping one of any other column can not be answered
+    other = next(c for c in db.base_filters if c not in split)
+    assert sketch.select(sketches, dict(ex, **{other: ex[other][1:]})) is None
+    db.db['sketches'] = sketches
+    db.db['sketch_min_rows'] = 0
+    try:
+        restricted = dict(ex, approximate=True, **{other: ex[other][1:]})
+        assert (db.filter_to_tukey(restricted).rank_error == 0).all()
+    finally:
+        del db.db['sketches']
+
+test_tukey_sketch_strata(everyone)
+
+from lifelines import KaplanMeierFitter
+
+# Test the vectorized Kaplan Meier curves against lifelines group by group
+def test_kaplan_meier(seed):
+    rng = np.random.default_rng(seed)
+    T = rng.integers(1, 40, 300)
+    E = rng.random(300) < 0.6
+    groups = rng.integers(0, 3, 300)
+    # A group whose last time is a death, so its curve reaches zero
+    T[groups == 2] = np.minimum(T[groups == 2], 30)
+    E[(groups == 2) & (T == 30)] = True
+    curves, at = stats.kaplan_meier(stats.event_table(T, E, groups, 3))
+    for g in range(3):
+        kmf = KaplanMeierFitter().fit(T[groups == g], E[groups == g], label='KM')
+        curve = curves[curves.group == g]
+        assert np.array_equal(curve.time, kmf.survival_function_.index)
+        assert np.allclose(curve.fit, kmf.survival_function_.KM, rtol=1e-12)
+        ci = kmf.confidence_interval_survival_function_
+        assert np.allclose(curve.lower, ci.iloc[:, 0], rtol=1e-12)
+        assert np.allclose(curve.upper, ci.iloc[:, 1], rtol=1e-12)
+        rows = np.flatnonzero(groups == g)
+        assert np.allclose(curves.fit.to_numpy()[at[rows]], kmf.survival_function_at_times(T[rows]), rtol=1e-12)
+
+test_kaplan_meier(0)
+test_kaplan_meier(1)
+
+from lifelines.statistics import multivariate_logrank_test
+
+# Test the log-rank test against lifelines, and the stratified test on a
+# cohort repeated in two strata, which doubles the statistic
+def test_logrank(seed, num_groups):
+    rng = np.random.default_rng(seed)
+    T = rng.integers(1, 40, 300)
+    E = rng.random(300) < 0.6
+    groups = rng.integers(0, num_groups, 300)
+    statistic, p, dof = stats.logrank(stats.event_table(T, E, groups, num_groups))
+    expected = multivariate_logrank_test(T, groups, E)
+    assert np.isclose(statistic, expected.test_statistic, rtol=1e-10)
+    assert np.isclose(p, expected.p_value, rtol=1e-8)
+    assert dof == num_groups - 1
+
+    twice = stats.event_table(np.r_[T, T], np.r_[E, E], np.r_[groups, groups], num_groups, np.repeat([0, 1], 300))
+    assert np.isclose(stats.logrank(twice)[0], 2 * statistic, rtol=1e-10)
+
+test_logrank(0, 2)
+test_logrank(1, 4)
+
+# The cutpoints' group sizes reproduce their log-rank statistic in filter_survival
+def test_cutpoints(ex, cell_full):
+    res = db.cutpoints(dict(ex, cell_full=cell_full))
+    for cut in [res['best'], res['cutpoints'][0], res['cutpoints'][-1]]:
+        survival = db.filter_survival(dict(ex, cell_full=cell_full, num_groups=2, group_sizes=[cut['size_low'], cut['size_high']]))
+        assert np.isclose(survival['log_rank']['test_statistic_logrank'], cut['statistic'], rtol=1e-9)
+    assert res['best']['statistic'] == max(cut['statistic'] for cut in res['cutpoints'])
+    assert res['best']['p'] <= res['p_corrected'] <= 1
+
+test_cutpoints(example_body, 'CD8_TUMOR')
+test_cutpoints(example_body2, 'M2_STROMA')
+
+def test_cutpoints_thinned(ex):
+    full = db.cutpoints(dict(ex, cell_full='CD8_TUMOR', max_points=10**9))
+    res = db.cutpoints(dict(ex, cell_full='CD8_TUMOR', max_points=20))
+    assert 20 <= len(res['cutpoints']) <= 21 < len(full['cutpoints'])
+    assert res['best'] == full['best'] and res['best'] in res['cutpoints']
+    assert res['cutpoints'][0] == full['cutpoints'][0] and res['cutpoints'][-1] == full['cutpoints'][-1]
+
+    # A cohort without deaths has no split to compare
+    current = db.db.current()
+    db.db.swap(db.dotdict(current, data=current.data.assign(E=False)))
+    try:
+        db.cutpoints(dict(ex, cell_full='CD8_TUMOR'))
+        assert False
+    except ValueError:
+        pass
+    finally:
+        db.db.swap(current)
+
+test_cutpoints_thinned(example_body)
+
+def test_dominance_sums():
+    rng = np.random.default_rng(0)
+    for n, span in [(1, 1), (7, 3), (100, 10), (257, 300)]:
+        rank, weights = rng.integers(0, span, n), rng.random(n)
+        count, total = stats.dominance_sums(rank, weights)
+        for k in range(n):
+            earlier = rank[:k] <= rank[k]
+            assert count[k] == earlier.sum() and np.isclose(total[k], weights[:k][earlier].sum())
+
+test_dominance_sums()
+
+import threading
+import time
+
+# Concurrent misses of one key run a single computation
+def test_single_flight():
+    c = LRUCache(10)
+    calls = []
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'value'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(c.get_or_compute('a', compute))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == ['value'] * 8
+    assert c.stats()['coalesced'] >= 1
+
+    def fail():
+        raise ValueError('failed')
+    try:
+        c.get_or_compute('b', fail)
+        assert False
+    except ValueError:
+        pass
+    assert c.get('b') is None
+
+test_single_flight()
+
+def test_survival_cache(ex):
+    body = dict(ex, cell_full='CD8_TUMOR', num_groups=2, group_sizes=None)
+    reordered = dict(body, tumors=list(reversed(ex['tumors'])))
+    assert db.filter_survival(body) is db.filter_survival(reordered)
+    assert db.filter_survival(body) is not db.filter_survival(dict(body, num_groups=3))
+
+test_survival_cache(example_body)
+
+import os
+import subprocess
+import sys
+import workers
+
+# Analyses in the worker processes: same results, a bounded queue and timeouts.
+# The workers start like in the server, in a process whose main module is
+# not this one, since a forkserver's children import the main module.
+worker_test = '''
+import os, sys, json, time
+# Under uwsgi sys.executable is the uwsgi binary
+sys.executable = os.path.join(sys.exec_prefix, 'bin', 'uwsgi')
+import database as db
+import workers
+ex = json.loads(sys.argv[1])
+body = dict(ex, cell_full='M2_STROMA', num_groups=2, group_sizes=None)
+assert workers.run(db.survival_analysis, body) == db.survival_analysis(body)
+assert workers.run_all(db.filter_to_tukey, [ex])[0].equals(db.filter_to_tukey(ex))
+# Analyses of a version other than the workers' run in the request thread
+assert workers.run(os.getpid) != os.getpid()
+# A request pinned before a reload
+latest = db.db.current()
+db.db.swap(db.dotdict(latest, version='older'))
+db.db.pin()
+db.db.swap(latest)
+assert workers.run(os.getpid) == os.getpid()
+db.db.unpin()
+assert workers.run(os.getpid) != os.getpid()
+workers.timeout = 0.5
+try:
+    workers.run(time.sleep, 1)
+    assert False
+except workers.Timeout:
+    pass
+try:
+    workers.run(abs, -1)
+    assert False
+except workers.Busy:
+    pass
+workers.reset()
+'''
+
+def test_workers(ex):
+    env = dict(os.environ, ANALYSIS_WORKERS='1', ANALYSIS_QUEUE='1', ANALYSIS_TIMEOUT='120')
+    subprocess.run([sys.executable, '-c', worker_test, json.dumps(ex)], env=env, check=True, timeout=300)
+
+test_workers(example_body)
+
+# The forest plot table fitted in a pool equals the serial one
+forest_test = '''
+import database as db
+from forest import forest_table
+data = db.db.data
+tumors = list(data.Tumor_type_code.unique()[:3])
+cells = list(db.db.cell_meta.index)
+serial = forest_table(data, tumors, cells)
+parallel = forest_table(data, tumors, cells, workers=2)
+assert len(parallel) == len(tumors)
+for a, b in zip(serial, parallel):
+    assert a.equals(b)
+'''
+
+def test_forest_workers():
+    subprocess.run([sys.executable, '-c', forest_test], check=True, timeout=300)
+
+test_forest_workers()
+
+import gzip
+import brotli
+from flask import Flask, request
+import payloads
+
+def test_payloads():
+    app = Flask(__name__)
+    payload = payloads.Payload(json.dumps(db.configuration()).encode(), 'application/json', 'v1', 0)
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = payloads.respond(payload, request)
+        assert response.status_code == 200
+        assert json.loads(gzip.decompress(response.get_data())) == db.configuration()
+        etag = response.headers['ETag']
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}):
+        assert payloads.respond(payload, request).status_code == 304
+    with app.test_request_context():
+        response = payloads.respond(payload, request)
+        assert 'Content-Encoding' not in response.headers
+        assert response.headers['ETag'] != etag
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip, br'}):
+        response = payloads.respond(payload, request)
+        assert response.headers['Content-Encoding'] == 'br'
+        assert json.loads(brotli.decompress(response.get_data())) == db.configuration()
+
+test_payloads()
+
+import wire
+
+# The column-wise JSON writer gives the records jsonify would
+def test_records_json(ex):
+    df = db.filter(ex)
+    assert json.loads(wire.records_json(df)) == df.to_dict(orient='records')
+    df = db.filter_to_tukey(ex)
+    assert json.loads(wire.records_json(df, nan='"NaN"')) == df.fillna('NaN').to_dict(orient='records')
+    values = db.expression(dict(ex, cell_full='CD8_TUMOR'))
+    assert json.loads(wire.array_json(values.to_numpy())) == values.to_list()
+
+test_records_json(example_body)
+test_records_json(example_body2)
+
+import msgpack
+import pyarrow as pa
+
+def decode_columnar(body):
+    return [
+        {c: [v['dictionary'][k] for k in v['codes']] if isinstance(v, dict) else v for c, v in frame['columns'].items()}
+        for frame in body
+    ]
+
+# The compact formats hold the records, with missing numbers as null
+def test_wire_formats(ex):
+    frames = [db.filter(ex), db.filter_to_tukey(ex)]
+    missing = lambda v: None if v == 'missing' else v
+    expected = [
+        {c: [missing(row[c]) for row in json.loads(wire.records_json(df))] for c in df.columns}
+        for df in frames
+    ]
+    assert decode_columnar(json.loads(wire.encode(frames, wire.COLUMNAR_JSON))) == expected
+    assert decode_columnar(msgpack.unpackb(wire.encode(frames, wire.MSGPACK))) == expected
+    table = pa.ipc.open_stream(wire.encode(frames, wire.ARROW)).read_all().to_pydict()
+    for i, columns in enumerate(expected):
+        rows = [j for j, body in enumerate(table['body']) if body == i]
+        for c, values in columns.items():
+            assert [table[c][j] for j in rows] == values, c
+    assert wire.mimetypes() == [wire.JSON, wire.COLUMNAR_JSON, wire.MSGPACK, wire.ARROW]
+
+test_wire_formats(example_body)
+
+# Missing numbers are null whether orjson is installed or not
+def test_dumps():
+    obj = {'b': float('nan'), 'a': [np.float64('inf'), 1.5, np.int64(2)], 'c': np.array([0.25, np.nan])}
+    expected = b'{"a":[null,1.5,2],"b":null,"c":[0.25,null]}'
+    assert wire.dumps(obj) == expected
+    installed = wire.orjson
+    wire.orjson = None
+    try:
+        assert wire.dumps(obj) == expected
+    finally:
+        wire.orjson = installed
+
+test_dumps()
+
+import os
+import tempfile
+import content
+
+def test_content_document():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'content.json')
+        with open(path, 'w') as fp:
+            json.dump({'a': 1}, fp)
+        document = content.Document(path)
+        first = document.get()
+        assert document.get() is first
+        document.put({'a': 2})
+        assert json.loads(document.get().encodings['identity']) == {'a': 2}
+        assert document.get().version != first.version
+        assert os.listdir(directory) == ['content.json']
+
+test_content_document()
+
+import store
+
+# Cache entries are keyed by schema version and dataset contents
+def test_store_key():
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = os.path.join(directory, 'data.csv')
+        with open(dataset, 'w') as fp:
+            fp.write('a\n1\n')
+        key = store.entry_key(dataset, 1)
+        assert store.entry_key(dataset, 1) == key
+        assert store.entry_key(dataset, 2) != key
+        with open(dataset, 'w') as fp:
+            fp.write('a\n2\n')
+        assert store.entry_key(dataset, 1) != key
+
+test_store_key()
+
+# One of several concurrent callers builds a missing entry, the others load
+# it, and old entries are pruned
+def test_store_load_or_create():
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = os.path.join(directory, 'data.csv')
+        with open(dataset, 'w') as fp:
+            fp.write('a\n1\n')
+        cache = os.path.join(directory, 'cache')
+        built = []
+        def create():
+            built.append(1)
+            time.sleep(0.2)
+            return {'rows': 1}
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(store.load_or_create(dataset, 1, create, cache))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(built) == 1
+        assert [db for _, db in results] == [{'rows': 1}] * 3
+        first = 'db-' + results[0][0]
+        assert sorted(os.listdir(cache)) == ['.lock', first]
+
+        # A failed build leaves no entry or temporary directory behind
+        def fail():
+            raise RuntimeError('build failed')
+        try:
+            store.load_or_create(dataset, 2, fail, cache)
+            assert False
+        except RuntimeError:
+            pass
+        assert sorted(os.listdir(cache)) == ['.lock', first]
+
+        # Building a third version keeps the two newest, the new one included
+        second = 'db-' + store.load_or_create(dataset, 2, lambda: {'rows': 2}, cache, keep=2)[0]
+        for age, name in [(20, first), (10, second)]:
+            os.utime(os.path.join(cache, name), (time.time() - age, time.time() - age))
+        key, _ = store.load_or_create(dataset, 3, lambda: {'rows': 3}, cache, keep=2)
+        assert sorted(os.listdir(cache)) == sorted(['.lock', second, 'db-' + key])
+        assert store.load_or_create(dataset, 3, fail, cache) == (key, {'rows': 3})
+
+test_store_load_or_create()
+
+# Atomic writes replace the file whole and leave no temporary file
+def test_atomic_write():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'file')
+        store.atomic_write(path, b'old')
+        store.atomic_write(path, b'new', mode=0o644)
+        with open(path, 'rb') as fp:
+            assert fp.read() == b'new'
+        assert os.listdir(directory) == ['file']
+        assert os.stat(path).st_mode & 0o777 == 0o644
+
+test_atomic_write()
+
+import columnar
+
+# Writing a frame in the columnar layout and mapping it back gives the frame
+def test_columnar_round_trip():
+    data = pd.read_csv('./SIM.csv').iloc[:500]
+    data['E'] = data['Event_last_followup'] == 'Dead'
+    cells = [c for c in data.columns if 'TUMOR' in c or 'STROMA' in c]
+    data.loc[::7, cells[0]] = np.nan
+    with tempfile.TemporaryDirectory() as directory:
+        columnar.write_frame(directory, data, cells)
+        read = columnar.read_frame(directory)
+        assert list(read.columns) == list(data.columns)
+        for c in data.columns:
+            if data[c].dtype.kind in 'biuf':
+                assert read[c].equals(data[c]), c
+            else:
+                assert read[c].dtype == 'category', c
+                assert read[c].astype(object).equals(data[c]), c
+        # Missing categories can be filled like in the source
+        assert read.Diff_grade.isnull().any()
+        assert read.Diff_grade.fillna('missing').astype(object).equals(data.Diff_grade.fillna('missing'))
+
+test_columnar_round_trip()
+
+# A reload swaps in a new version while pinned readers keep the old one
+def test_reload(ex):
+    old = db.db.current()
+    size = db.calculate_size(ex)['size']
+    settings = {k: os.environ.get(k) for k in ['DATASET', 'DB_CACHE']}
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = os.path.join(directory, 'SIM.csv')
+        # Other datasets than ./SIM.csv have the column names of the real data
+        sim = pd.read_csv('./SIM.csv').iloc[:2000]
+        sim['MSI'], sim['clinicl_stge'], sim['Atomical_location'] = sim.MSI_ARTUR, sim.clinical_stage, sim.Anatomical_location
+        sim.to_csv(dataset, index=False)
+        os.environ['DATASET'], os.environ['DB_CACHE'] = dataset, os.path.join(directory, 'cache')
+        try:
+            seen = {}
+            pinned, reloaded = threading.Event(), threading.Event()
+            def request():
+                db.db.pin()
+                pinned.set()
+                reloaded.wait()
+                seen['size'] = db.calculate_size(ex)['size']
+                db.db.unpin()
+            thread = threading.Thread(target=request)
+            thread.start()
+            pinned.wait()
+            try:
+                db.reload()
+            finally:
+                reloaded.set()
+                thread.join()
+            assert db.db.version != old.version
+            assert len(db.db.data) == 2000
+            assert seen['size'] == size
+            assert db.calculate_size(ex)['size'] < size
+        finally:
+            db.db.swap(old)
+            for k, v in settings.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+test_reload(example_body)
+
+import metrics
+
+def test_metrics(ex):
+    histogram = metrics.Histogram('test_seconds', 'Test.', [0.1, 1])
+    histogram.observe(0.05, endpoint='/a')
+    histogram.observe(0.5, endpoint='/a')
+    histogram.observe(5, endpoint='/a')
+    lines = histogram.render()
+    assert 'test_seconds_bucket{endpoint="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{endpoint="/a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{endpoint="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{endpoint="/a"} 3' in lines
+    metrics.registry.remove(histogram)
+
+    # A filter not in the cache, so that its rows are selected anew
+    db.filter_to_tukey(dict(ex, clinical_stage=['I']))
+    text = metrics.render()
+    assert 'encam_phase_duration_seconds_count{phase="statistics"}' in text
+    assert 'encam_phase_duration_seconds_count{phase="filtering"}' in text
+
+test_metrics(example_body)
+
+import profiling
+
+def test_profiling(ex):
+    with tempfile.TemporaryDirectory() as directory:
+        ring = profiling.Ring(directory, keep=2)
+        for i in range(3):
+            profile = profiling.Request(ring)
+            assert profile.start()
+            # Only one profile at a time
+            assert not profiling.Request(ring).start()
+            assert workers.inline()
+            db.filter_to_tukey(ex)
+            name = profile.stop('/api/tukey', 'POST', ex, 200)
+            assert not workers.local.inline
+        assert len(ring.names()) == 2 and ring.names()[0] == name
+        assert len(os.listdir(directory)) == 4
+        assert ring.list()[0]['body'] == ex
+        assert 'filter_to_tukey' in ring.text(name)
+
+test_profiling(example_body)
+
+import synth
+
+def test_synth():
+    sim = pd.read_csv('./SIM.csv')
+    model = synth.learn(sim)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, name) for name in ['a.csv', 'b.csv']]
+        for path in paths:
+            synth.generate(model, 3000, path, seed=1, chunk_size=1000)
+        with open(paths[0], 'rb') as a, open(paths[1], 'rb') as b:
+            assert a.read() == b.read()
+        data = pd.read_csv(paths[0])
+        assert len(data) == 3000 and data.Pat_ID.is_unique
+        assert set(data.Tumor_type_code) <= set(sim.Tumor_type_code)
+        # Tumor specific columns stay missing for the other tumor types
+        assert data.Anatomical_location.notna().groupby(data.Tumor_type_code).any().sum() == \
+            sim.Anatomical_location.notna().groupby(sim.Tumor_type_code).any().sum()
+        built = db.init(paths[0])
+        assert len(built['data']) == 3000
+        assert built['cell_types'] == db.db.cell_types
+
+        # Patients with a missing status get follow-up times too
+        sim.loc[::50, synth.EVENT] = np.nan
+        model = synth.learn(sim)
+        for path in paths:
+            synth.generate(model, 3000, path, seed=1, chunk_size=1000)
+        with open(paths[0], 'rb') as a, open(paths[1], 'rb') as b:
+            assert a.read() == b.read()
+        data = pd.read_csv(paths[0])
+        missing = data[synth.EVENT].isna()
+        assert missing.any()
+        assert data[synth.TIME][missing].between(sim[synth.TIME].min(), sim[synth.TIME].max()).all()
+
+test_synth()
+
+import loadtest
+
+def test_loadtest():
+    # Synthesized bodies are filters the database accepts
+    rng = np.random.default_rng(0)
+    requests = loadtest.synthesize(db.configuration(), loadtest.parse_mix(loadtest.DEFAULT_MIX), rng)
+    for _ in range(20):
+        item = next(requests)
+        if item['path'] == '/api/size':
+            assert db.calculate_size(item['body'])['size'] >= 0
+        elif item['path'] == '/api/tukey':
+            for body in item['body']:
+                db.filter_to_tukey(body)
+    results = [('/a', 0.1, 200, 10), ('/a', 0.3, 500, 20), ('/b', 0.2, None, 0)]
+    summary = loadtest.summarize(results, wall=2.0)
+    assert summary['/a']['requests'] == 2 and summary['/a']['error_rate'] == 0.5
+    assert summary['total']['errors'] == 2 and summary['total']['per_second'] == 1.5
+    assert abs(summary['/a']['p50_ms'] - 200) < 1e-9
+
+test_loadtest()
+
+import asyncio
+import server
+
+# Requests on the old and the new version during a reload each get the
+# payloads of their version, without rebuilding them
+def test_static_payloads():
+    old = db.db.current()
+    built = server.static_payload('database')
+    new = db.dotdict(old, version='new')
+    new.pop('payloads', None)
+    try:
+        db.db.swap(new)
+        rebuilt = server.static_payload('database')
+        assert rebuilt.version == 'new'
+        db.db.swap(old)
+        assert server.static_payload('database') is built
+        db.db.swap(new)
+        assert server.static_payload('database') is rebuilt
+    finally:
+        db.db.swap(old)
+
+test_static_payloads()
+
+import asgi
+
+def asgi_request(method, path, chunks=[b''], headers=[]):
+    messages = [{'type': 'http.request', 'body': c, 'more_body': i < len(chunks) - 1} for i, c in enumerate(chunks)]
+    sent = []
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': headers}
+    asyncio.run(asgi.app(scope, receive, send))
+    start, body = sent
+    assert start['type'] == 'http.response.start' and body['type'] == 'http.response.body'
+    return start['status'], dict(start['headers']), body['body']
+
+def test_asgi(ex):
+    status, headers, body = asgi_request('GET', '/api/ping')
+    assert (status, body) == (200, b'pong')
+    assert headers[b'content-type'].startswith(b'text/plain')
+
+    # A JSON body arriving in several messages, without a content-length
+    data = json.dumps(ex).encode()
+    chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+    status, _, body = asgi_request('POST', '/api/size', chunks, [(b'content-type', b'application/json')])
+    assert status == 200 and json.loads(body) == db.calculate_size(ex)
+
+    # Repeated headers are joined like a WSGI server does
+    status, headers, _ = asgi_request('GET', '/api/configuration', headers=[
+        (b'accept-encoding', b'br;q=0'), (b'accept-encoding', b'gzip'),
+    ])
+    assert status == 200 and headers[b'content-encoding'] == b'gzip'
+    environ = asgi.wsgi_environ({'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': [
+        (b'accept-encoding', b'br;q=0'), (b'accept-encoding', b'gzip'),
+    ]}, b'')
+    assert environ['HTTP_ACCEPT_ENCODING'] == 'br;q=0,gzip'
+
+    # Statuses an ASGI server would reject become 500
+    app = asgi.wsgi_app
+    asgi.wsgi_app = lambda environ, start_response: start_response('text/plain', []) or [b'']
+    try:
+        assert asgi.call_wsgi(environ)[0] == 500
+    finally:
+        asgi.wsgi_app = app
+
+test_asgi(example_body)
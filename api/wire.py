@@ -0,0 +1,194 @@
+'''
+Compact response formats for endpoints that return one frame per body.
+
+The default response stays a JSON list with a list of records per body.
+Clients can ask for one of these instead via the Accept header:
+
+* application/vnd.encam.columnar+json
+
+   A JSON list with one object per body, holding the number of rows and
+   the columns as lists. String columns are dictionary encoded as
+   {"dictionary": [...], "codes": [...]}, missing numbers are null.
+
+* application/msgpack
+
+   The same structure as the columnar JSON, encoded with msgpack.
+   Only offered when msgpack is installed.
+
+* application/vnd.apache.arrow.stream
+
+   One Arrow IPC stream with the frames of all bodies concatenated, string
+   columns dictionary encoded and a body column telling which body a row
+   belongs to. Only offered when pyarrow is installed.
+
+The default JSON is written by records_json straight from the columns,
+without building a dict per row, and other responses go through dumps, which
+uses orjson when installed.
+'''
+import json
+import math
+import numpy as np
+import pandas as pd
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = 'application/json'
+COLUMNAR_JSON = 'application/vnd.encam.columnar+json'
+MSGPACK = 'application/msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+def mimetypes():
+    '''
+    The available formats, the records JSON default first.
+    '''
+    return [JSON, COLUMNAR_JSON] + ([MSGPACK] if msgpack else []) + ([ARROW] if pa else [])
+
+def is_strings(values):
+    return values.dtype == object and all(isinstance(v, str) for v in values)
+
+def numbers(values):
+    # 'missing' markers and NaN both become missing numbers
+    return pd.to_numeric(pd.Series(values).replace('missing', np.nan), errors='coerce').to_numpy(dtype=float)
+
+def columnar(df):
+    columns = {}
+    for c in df.columns:
+        values = df[c].to_numpy()
+        if is_strings(values):
+            codes, dictionary = pd.factorize(values)
+            columns[c] = {'dictionary': list(dictionary), 'codes': codes.tolist()}
+        else:
+            columns[c] = [None if np.isnan(x) else x for x in numbers(values).tolist()]
+    return {'length': len(df), 'columns': columns}
+
+def arrow_table(frames):
+    df = pd.concat(
+        [frame.assign(body=i) for i, frame in enumerate(frames)],
+        ignore_index=True,
+    )
+    arrays = {}
+    for c in df.columns:
+        values = df[c].to_numpy()
+        if c == 'body':
+            arrays[c] = pa.array(values, type=pa.int32())
+        elif is_strings(values):
+            arrays[c] = pa.array(values, type=pa.string()).dictionary_encode()
+        else:
+            arrays[c] = pa.array(numbers(values), from_pandas=True)
+    return pa.table(arrays)
+
+def encode(frames, mimetype):
+    if mimetype == COLUMNAR_JSON:
+        return json.dumps([columnar(df) for df in frames]).encode()
+    elif mimetype == MSGPACK:
+        return msgpack.packb([columnar(df) for df in frames])
+    elif mimetype == ARROW:
+        sink = pa.BufferOutputStream()
+        table = arrow_table(frames)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    else:
+        raise ValueError('Unsupported format %s' % mimetype)
+
+def json_value(value, nan='null'):
+    if isinstance(value, (float, np.floating)):
+        return json_float(float(value), nan)
+    if isinstance(value, np.generic):
+        value = value.item()
+    return json.dumps(value)
+
+def json_float(value, nan='null'):
+    if value != value:
+        return nan
+    # Infinities as jsonify writes them
+    return json.dumps(value)
+
+def float_texts(values, nan='null'):
+    if orjson:
+        texts = orjson.dumps(values, option=orjson.OPT_SERIALIZE_NUMPY).decode()[1:-1].split(',')
+    else:
+        texts = list(map(float.__repr__, values.tolist()))
+    texts = np.array(texts, dtype=object)
+    special = ~np.isfinite(values)
+    texts[special] = [json_float(v, nan) for v in values[special].tolist()]
+    return texts
+
+def json_texts(values, nan='null'):
+    '''
+    The JSON text of every value of a column, as an object array. Missing
+    numbers are written as nan.
+    '''
+    values = np.asarray(values)
+    kind = values.dtype.kind
+    if kind == 'f':
+        return float_texts(values.astype(np.float64, copy=False), nan)
+    elif kind in 'iu':
+        return values.astype(str).astype(object)
+    elif kind == 'b':
+        return np.where(values, 'true', 'false').astype(object)
+    # Floats mixed with other values, like expression with 'missing'
+    is_float = np.fromiter((type(v) is float for v in values.tolist()), dtype=bool, count=len(values))
+    texts = np.empty(len(values), dtype=object)
+    if is_float.any():
+        texts[is_float] = float_texts(values[is_float].astype(np.float64), nan)
+    # Each distinct other value is written once, missing ones get code -1
+    codes, uniques = pd.factorize(values[~is_float])
+    texts[~is_float] = np.array([json_value(v, nan) for v in uniques] + [nan], dtype=object)[codes]
+    return texts
+
+def records_json(df, nan='null'):
+    '''
+    df.to_dict(orient='records') as JSON text, keys sorted like jsonify.
+    '''
+    if len(df) == 0:
+        return '[]'
+    rows = None
+    for i, c in enumerate(sorted(df.columns)):
+        key = ('{' if i == 0 else ',') + json.dumps(c) + ':'
+        texts = key + json_texts(df[c].to_numpy(), nan)
+        rows = texts if rows is None else rows + texts
+    if rows is None:
+        return '[' + ','.join(['{}'] * len(df)) + ']'
+    return '[' + '},'.join(rows) + '}]'
+
+def array_json(values, nan='null'):
+    return '[' + ','.join(json_texts(values, nan)) + ']'
+
+def finite(obj):
+    '''
+    obj with NaN and infinities replaced by None, as orjson writes them.
+    '''
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [finite(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return finite(obj.tolist())
+    if isinstance(obj, np.generic):
+        return finite(obj.item())
+    return obj
+
+def dumps(obj):
+    '''
+    obj as JSON bytes with sorted keys like jsonify. NumPy values are
+    supported and missing numbers become null, with or without orjson.
+    '''
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(finite(obj), sort_keys=True, separators=(',', ':'), allow_nan=False).encode()
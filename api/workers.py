@@ -0,0 +1,165 @@
+'''
+Process pool for the CPU heavy analyses, so that they do not hold the GIL
+the request threads share.
+
+The pool has ANALYSIS_WORKERS processes, started when the first analysis
+arrives. They are forked from a forkserver process rather than from the
+server, whose request threads may hold locks at that moment, and load the
+database from the memory-mapped store when they start. Under uwsgi the
+forkserver runs the python binary, not uwsgi. At most ANALYSIS_QUEUE
+analyses (by default twice the workers) run or wait at a time, more raise
+Busy. A request waiting longer than ANALYSIS_TIMEOUT seconds for
+its analyses raises Timeout. With ANALYSIS_WORKERS 0, the default, analyses
+run in the request thread, as they do in threads that set local.inline.
+
+Every analysis carries the database version of the request that submitted
+it. A worker with another version, which happens around a reload, raises
+Stale and the analysis runs in the request thread instead. Reloads replace
+the pool, so new workers have the new version.
+'''
+import os
+import sys
+import time
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+start_method = 'forkserver'
+num_workers = int(os.getenv('ANALYSIS_WORKERS', '0'))
+queue_size = int(os.getenv('ANALYSIS_QUEUE', str(2 * num_workers)))
+timeout = float(os.getenv('ANALYSIS_TIMEOUT', '60'))
+
+# Seconds clients are asked to wait before retrying when the queue is full
+RETRY_AFTER = 5
+
+class Busy(Exception):
+    pass
+
+class Timeout(Exception):
+    pass
+
+class Stale(Exception):
+    '''
+    Raised in a worker that does not have the database version of an analysis.
+    '''
+
+pool = None
+lock = threading.Lock()
+slots = threading.BoundedSemaphore(max(queue_size, 1))
+local = threading.local()
+
+def inline():
+    return num_workers <= 0 or getattr(local, 'inline', False)
+
+def init_worker():
+    # database.py loads the database when imported, and imports this module
+    import database
+
+def current_version():
+    import database
+    return database.db.version
+
+def call(version, fn, args):
+    import database
+    if database.db.version != version:
+        raise Stale()
+    return fn(*args)
+
+def interpreter():
+    '''
+    The python binary the forkserver runs, which under uwsgi is not
+    sys.executable (the uwsgi binary).
+    '''
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+    return os.path.join(sys.exec_prefix, 'bin', 'python%d.%d' % sys.version_info[:2])
+
+def context():
+    '''
+    The multiprocessing context for process pools in the server.
+    '''
+    context = multiprocessing.get_context(start_method)
+    context.set_executable(interpreter())
+    return context
+
+def get_pool():
+    global pool
+    with lock:
+        if pool is None:
+            pool = ProcessPoolExecutor(num_workers, mp_context=context(), initializer=init_worker)
+        return pool
+
+def reset():
+    '''
+    Shuts the pool down, the next analysis forks new workers.
+    '''
+    global pool
+    with lock:
+        old, pool = pool, None
+    if old is not None:
+        old.shutdown(wait=False)
+
+def submit(fn, *args):
+    slot = slots
+    if not slot.acquire(blocking=False):
+        raise Busy()
+    try:
+        future = get_pool().submit(call, current_version(), fn, args)
+    except BrokenProcessPool:
+        # A worker died, start over with a new pool
+        slot.release()
+        reset()
+        raise
+    except BaseException:
+        slot.release()
+        raise
+    future.add_done_callback(lambda _: slot.release())
+    return future
+
+def wait(futures, fallbacks):
+    '''
+    The results of the futures, with those of the stale ones computed by
+    their fallbacks in this thread.
+    '''
+    deadline = time.monotonic() + timeout
+    results = []
+    try:
+        for future, fallback in zip(futures, fallbacks):
+            try:
+                results.append(future.result(timeout=max(deadline - time.monotonic(), 0)))
+            except Stale:
+                results.append(fallback())
+    except TimeoutError:
+        for future in futures:
+            future.cancel()
+        raise Timeout()
+    except BrokenProcessPool:
+        reset()
+        raise
+    return results
+
+def run(fn, *args):
+    '''
+    fn(*args), in a worker when there are workers.
+    '''
+    if inline():
+        return fn(*args)
+    return wait([submit(fn, *args)], [lambda: fn(*args)])[0]
+
+def run_all(fn, items):
+    '''
+    [fn(item) for item in items], in parallel when there are workers.
+    '''
+    if inline():
+        return [fn(item) for item in items]
+    futures = []
+    try:
+        for item in items:
+            futures.append(submit(fn, item))
+    except Busy:
+        for future in futures:
+            future.cancel()
+        raise
+    return wait(futures, [functools.partial(fn, item) for item in items])